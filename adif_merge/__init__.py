@@ -27,17 +27,35 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
+import contextlib
 import csv
+import functools
+import heapq
+import io
 import json
 import logging
 import math
+import multiprocessing
 import re
 import os
 import sys
 import string
-from datetime import datetime, timedelta
-
-import adif_io
+import time
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from operator import itemgetter
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+try:
+    import numpy
+except ImportError:  # optional, see merge_qsos()
+    numpy = None
 
 __PROGRAM__ = "adif_merge_pst"
 __VERSION__ = "1.1.2"
@@ -53,6 +71,9 @@ MERGE_DISTANCE_PCT = 0.15
 # ADIF files are supposed to be strict ascii, but conventionally they are really ISO-8859-1
 ADIF_ENCODING = "latin-1"
 
+# read ADIF input in chunks this large rather than slurping whole files
+ADIF_CHUNK_SIZE = 1024 * 1024
+
 # WSJT-X generated fields, minimal output fields as well
 FIELD_ORDER = [
     'CALL',
@@ -121,6 +142,115 @@ class QSOError(ValueError):
     """Malformed ADIF QSO Entry"""
 
 
+class ADIFFormatError(ValueError):
+    """Malformed ADIF File"""
+
+
+# QSORecord keeps these fields in a fixed slot list, anything else in a dict
+RECORD_FIELDS = FIELD_ORDER + ['_SOURCE_FILE', '_UNMERGED']
+_RECORD_SLOTS = {field: slot for slot, field in enumerate(RECORD_FIELDS)}
+# bands, modes, dates, times and QSL flags repeat endlessly, share them
+_RECORD_INTERN_LEN = 8
+_UNSET = object()
+
+
+class QSORecord(MutableMapping):
+    """
+    Memory compact QSO record which behaves like a dict.
+
+    The RECORD_FIELDS live in a fixed size list, rarer fields (APP_* and
+    friends) in an overflow dict which only exists when needed.  Short
+    string values and field names are interned so that every record
+    shares them.
+    """
+    __slots__ = ('_values', '_extra')
+
+    def __init__(self, fields=None):
+        self._values = [_UNSET] * len(RECORD_FIELDS)
+        self._extra = None
+        if fields:
+            for field, value in fields.items():
+                self[field] = value
+
+    def __getitem__(self, field):
+        slot = _RECORD_SLOTS.get(field)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(field)
+            return self._extra[field]
+        value = self._values[slot]
+        if value is _UNSET:
+            raise KeyError(field)
+        return value
+
+    def get(self, field, default=None):
+        slot = _RECORD_SLOTS.get(field)
+        if slot is None:
+            if self._extra is None:
+                return default
+            return self._extra.get(field, default)
+        value = self._values[slot]
+        if value is _UNSET:
+            return default
+        return value
+
+    def __contains__(self, field):
+        slot = _RECORD_SLOTS.get(field)
+        if slot is None:
+            return self._extra is not None and field in self._extra
+        return self._values[slot] is not _UNSET
+
+    def __setitem__(self, field, value):
+        if type(value) is str and len(value) <= _RECORD_INTERN_LEN:
+            value = sys.intern(value)
+        slot = _RECORD_SLOTS.get(field)
+        if slot is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[sys.intern(field)] = value
+        else:
+            self._values[slot] = value
+
+    def __delitem__(self, field):
+        slot = _RECORD_SLOTS.get(field)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(field)
+            del self._extra[field]
+            if not self._extra:
+                self._extra = None
+        elif self._values[slot] is _UNSET:
+            raise KeyError(field)
+        else:
+            self._values[slot] = _UNSET
+
+    def __iter__(self):
+        for field, value in zip(RECORD_FIELDS, self._values):
+            if value is not _UNSET:
+                yield field
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        length = len(self._values) - self._values.count(_UNSET)
+        if self._extra is not None:
+            length += len(self._extra)
+        return length
+
+    def __repr__(self):
+        return "QSORecord({!r})".format(dict(self))
+
+    def __sizeof__(self):
+        # the slot list and overflow dict are part of the record
+        size = object.__sizeof__(self) + sys.getsizeof(self._values)
+        if self._extra is not None:
+            size += sys.getsizeof(self._extra)
+        return size
+
+    def __reduce__(self):
+        return (QSORecord, (dict(self),))
+
+
 _WSTRANS = str.maketrans('', '', string.whitespace)
 
 def comparable_string(val):
@@ -140,9 +270,128 @@ def fixup_qso_mode(qso):
     return qso
 
 
-def fixup_qso(qso, path=""):
+# TX_PWR should only be digits
+_RE_POWER = re.compile(r'([\d\.]+)[Ww]')
+# a redundant comment field that matches our RST_SENT and RST_RCVD
+_RE_RST_COMMENT = re.compile(r'Sent:?\s*([+-]?\d+)\s+Rcvd:?\s*([+-]?\d+)', re.IGNORECASE)
+
+
+def _fixup_integer(value):
+    """
+    Some broken logbooks (e.g. HRD) generate Numbers where there should be
+    Integers--accept them but turn them into ints.
+    """
+    return int(float(value))
+
+
+def _fixup_number(value):
+    """
+    Make a "Number" a float, unless it's whole in which case int
+    """
+    value = float(value)
+    (part, whole) = math.modf(value)
+    if not part:
+        return int(whole)
+    return value
+
+
+def _fixup_frequency(value):
+    """
+    Frequencies are rounded to 3 digits (kHz)
+    """
+    return round(float(value), 3)
+
+
+def _fixup_power(value):
+    """
+    Strip any units from TX_PWR/RX_PWR, and scale obvious milliwatts
+    """
+    if value == "NaN":
+        return None
+    match = _RE_POWER.search(value)
+    if match:
+        value = match.group(1)
+    value = float(value)
+    if value > 10000:
+        value //= 10000
+    return _fixup_number(value) or None
+
+
+def _fixup_call(value):
+    """
+    Some log sources replace / with _, restore /
+    """
+    return value.replace("_", "/").upper()
+
+
+def _fixup_gridsquare(value):
+    """
+    Properly "caseify" gridsquares... it's unnecessary but pleasant
+    """
+    return value[0:4].upper() + value[4:].lower()
+
+
+def _fixup_location(value):
+    """
+    Remove bad LAT/LON entries
+    """
+    if value[1:] == "000 00.000":
+        return None
+    return value
+
+
+def _fixup_iota(value):
+    """
+    Remove IOTA placeholders
+    """
+    if value.replace("-", "").lower().strip() == "none":
+        return None
+    return value
+
+
+def _fixup_nonzero(fixup):
+    """
+    Wrap a converter to remove bogus zero fields
+    """
+    def nonzero(value):
+        return fixup(value) or None
+    return nonzero
+
+
+def _build_field_fixups():
+    fixups = {}
+    for field in FIELD_INTEGERS + FIELD_INTEGERS_POS:
+        fixups[field] = _fixup_integer
+    for field in FIELD_NUMBERS:
+        fixups[field] = _fixup_number
+    fixups['FREQ'] = _fixup_frequency
+    for field in ['TX_PWR', 'RX_PWR']:
+        fixups[field] = _fixup_power
+    # band should always be uppercase
+    for field in ['BAND', 'BAND_RX']:
+        fixups[field] = str.upper
+    for field in ['CALL', 'MYCALL']:
+        fixups[field] = _fixup_call
+    for field in ['GRIDSQUARE', 'MY_GRIDSQUARE']:
+        fixups[field] = _fixup_gridsquare
+    for field in ['LAT', 'LON']:
+        fixups[field] = _fixup_location
+    fixups['IOTA'] = _fixup_iota
+    # remove bogus zero fields (DXCC zero is valid)
+    for field in ['A_INDEX', 'K_INDEX', 'SFI', 'DISTANCE'] + FIELD_ZONES:
+        fixups[field] = _fixup_nonzero(fixups[field])
+    return fixups
+
+
+# Field name -> converter applied to its (stripped, non-empty) value upon
+# load.  A converter returning None removes the field from the QSO.
+FIELD_FIXUPS = _build_field_fixups()
+
+
+def fixup_qso(qso, path="", compact=False):
     """
     Pre-process an individual QSO record upon load and fix common mistakes.
+    If compact, the fixed QSO is returned as a QSORecord rather than a dict.
     """
     if path:
         qso['_SOURCE_FILE'] = path
@@ -154,72 +403,27 @@ def fixup_qso(qso, path=""):
             path,
             "/".join([qso.get(field, field.lower()) for field in FIELD_MANDATORY]),
             ", ".join(missing_mandatory)), qso)
-    for field in qso.keys():
-        if isinstance(qso[field], str):
-            qso[field] = qso[field].strip()
-    qso = {key: value for key, value in qso.items() if value}
-    qso = fixup_qso_mode(qso)
-    # TX_PWR should only be digits
-    for field in ['TX_PWR', 'RX_PWR']:
-        if field in qso:
-            if qso[field] == "NaN":
-                del qso[field]
-            else:
-                match = re.search(r'([\d\.]+)[Ww]', qso[field])
-                if match:
-                    qso[field] = match.group(1)
-                qso[field] = float(qso[field])
-                if qso[field] > 10000:
-                    qso[field] //= 10000
-    # if the field is a "PositiveInteger" or "Integer" field, make it an int
-    # some broken logbooks (e.g. HRD) generate Numbers where there should be
-    # Integers--accept them but turn them into ints.
-    for field in FIELD_INTEGERS + FIELD_INTEGERS_POS:
-        if field in qso:
-            qso[field] = int(float(qso[field]))
-    # if the field is a "Number" make it a float, unless it's whole in which case int
-    for field in FIELD_NUMBERS:
-        if field in qso:
-            qso[field] = float(qso[field])
-            if field in ['FREQ', 'FREQ_TX']:
-                # round to 3 digits
-                qso[field] = round(qso[field], 3)
-            else:
-                # leave as an int if possible, otherwise float
-                (part, whole) = math.modf(float(qso[field]))
-                if not part:
-                    qso[field] = int(whole)
-    # band should always be uppercase
-    for field in ['BAND', 'BAND_RX']:
-        if field in qso:
-            qso[field] = qso[field].upper()
-    # some log sources replace / with _, restore /
-    for field in ['CALL', 'MYCALL']:
-        if field in qso:
-            qso[field] = qso[field].replace("_", "/").upper()
-    # properly "caseify" gridsquares... it's unnecessary but pleasant
-    for field in ['GRIDSQUARE', 'MY_GRIDSQUARE']:
-        if field in qso:
-            qso[field] = "{}{}".format(
-                qso[field][0:4].upper(), qso[field][4:].lower())
-    # remove bad LAT/LON entries
-    for field in ['LAT', 'LON']:
-        if field in qso and qso[field][1:] == "000 00.000":
-            del qso[field]
-    # remove bogus zero fields (DXCC zero is valid)
-    for field in ['A_INDEX', 'K_INDEX', 'SFI', 'DISTANCE', 'TX_PWR', 'RX_PWR'] + FIELD_ZONES:
-        if field in qso and not qso[field]:
-            del qso[field]
-    # look for a redundant comment field that matches our RST_SENT and RST_RCVD
-    for field in ['COMMENT', 'NOTES']:
-        if field in qso and 'RST_SENT' in qso and 'RST_RCVD' in qso:
-            match = re.search(r'Sent:?\s*([+-]?\d+)\s+Rcvd:?\s*([+-]?\d+)',
-                              qso[field], re.IGNORECASE)
-            if match and match.group(1) == qso['RST_SENT'] and match.group(2) == qso['RST_RCVD']:
-                del qso[field]
-    if qso.get('IOTA', "").replace("-", "").lower().strip() == "none":
-        del qso['IOTA']
-    return qso
+    fixed = QSORecord() if compact else {}
+    get_fixup = FIELD_FIXUPS.get
+    for field, value in qso.items():
+        if isinstance(value, str):
+            value = value.strip()
+        if not value:
+            continue
+        fixup = get_fixup(field)
+        if fixup is not None:
+            value = fixup(value)
+            if value is None:
+                continue
+        fixed[field] = value
+    fixed = fixup_qso_mode(fixed)
+    if 'RST_SENT' in fixed and 'RST_RCVD' in fixed:
+        for field in ['COMMENT', 'NOTES']:
+            if field in fixed:
+                match = _RE_RST_COMMENT.search(fixed[field])
+                if match and match.groups() == (fixed['RST_SENT'], fixed['RST_RCVD']):
+                    del fixed[field]
+    return fixed
 
 
 # If dupe comes from one of these sources, prefer dupe records over
@@ -231,6 +435,160 @@ SOURCE_OVERRIDES = {
     'CLUBLOG': r'APP_CLUBLOG_|CLUBLOG_',
     'HRD': r'APP_HRDLOG_|HRDLOG_|APP_HAMRADIODELUXE?_|HRDCOUNTRYNO$',
 }
+_SOURCE_OVERRIDES_RE = re.compile("|".join(
+    "(?P<{}>{})".format(source, match) for source, match in SOURCE_OVERRIDES.items()))
+
+# field and file names come from the logs, so in a long running service
+# the memoized lookups are bounded rather than growing with every upload
+FIELD_CACHE_SIZE = 4096
+FILE_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=FIELD_CACHE_SIZE)
+def field_override_source(field):
+    """
+    Return the source in SOURCE_OVERRIDES which is authoritative for field, if any.
+    """
+    match = _SOURCE_OVERRIDES_RE.match(field)
+    if match:
+        return match.lastgroup
+    return None
+
+
+@functools.lru_cache(maxsize=FILE_CACHE_SIZE)
+def file_sources(filename):
+    """
+    Return the set of SOURCE_OVERRIDES sources an input file name claims to come from.
+    """
+    filename = filename.upper()
+    return frozenset(source for source in SOURCE_OVERRIDES if source in filename)
+
+
+# Field name -> policy function(field, first, dupe) deciding between two
+# differing values.  A policy resolves the conflict by deleting the field
+# from dupe, after updating first if the dupe's value is preferred.
+# Anything a policy leaves in dupe falls through to the SOURCE_OVERRIDES.
+MERGE_POLICIES = {}
+
+
+def merge_policy(*fields):
+    """
+    Register the decorated function as the merge policy for fields,
+    replacing any policy previously registered for them.
+    """
+    def register(policy):
+        for field in fields:
+            MERGE_POLICIES[field] = policy
+        return policy
+    return register
+
+
+@merge_policy('NAME', 'MY_NAME', 'ADDRESS', 'MY_ADDRESS', 'STREET', 'MY_STREET',
+              'CITY', 'MY_CITY', 'CNTY', 'MY_CNTY', 'STATE', 'MY_STATE',
+              'COUNTRY', 'MY_COUNTRY',
+              'MY_RIG', 'COMMENT', 'EMAIL', 'QSLMSG', 'WEB', 'PFX', 'QSL_VIA', 'QTH')
+def merge_text_longest(field, first, dupe):
+    """
+    Free text: if dupe is identical but had whitespace, use the one with
+    whitespace else use the longer one if one is a substring of the other
+    """
+    fnslc = comparable_string(first[field])
+    dnslc = comparable_string(dupe[field])
+    if fnslc == dnslc:
+        if len(first[field]) < len(dupe[field]) or first[field].isupper():
+            first[field] = dupe[field]
+        del dupe[field]
+    elif fnslc in dnslc:
+        first[field] = dupe[field]
+        del dupe[field]
+    elif dnslc in fnslc:
+        del dupe[field]
+
+
+@merge_policy('TIME_ON', 'TIME_OFF', 'GRIDSQUARE')
+def merge_precision(field, first, dupe):
+    """
+    Times and grids: choose the field with higher precision
+    """
+    # handle the present but empty case
+    if not first[field]:
+        first[field] = dupe[field]
+        del dupe[field]
+    elif not dupe[field]:
+        del dupe[field]
+    elif first[field][0:4] == dupe[field][0:4]:
+        if len(dupe[field]) > len(first[field]):
+            first[field] = dupe[field]
+        del dupe[field]
+
+
+@merge_policy('DISTANCE')
+def merge_distance(field, first, dupe):
+    """
+    If the distance difference is less that 5 miles or 15%, choose the longer
+    """
+    difference = abs(first[field] - dupe[field])
+    if difference < MERGE_DISTANCE_ABS or difference / first[field] < MERGE_DISTANCE_PCT:
+        first[field] = max(first[field], dupe[field])
+        del dupe[field]
+
+
+@merge_policy('FREQ', 'FREQ_RX')
+def merge_frequency(field, first, dupe):
+    """
+    Frequencies within 10kHz are the same, choose the higher
+    """
+    if abs(first[field] - dupe[field]) < 0.01:
+        first[field] = max(first[field], dupe[field])
+        del dupe[field]
+
+
+@merge_policy('QSL_RCVD', 'QSL_SENT', 'EQSL_QSL_SENT', 'EQSL_QSL_RCVD',
+              'LOTW_QSL_SENT', 'LOTW_QSL_RCVD', 'QSO_RANDOM')
+def merge_qsl_upgrade(field, first, dupe):
+    """
+    QSL status only ever moves forward, from no/requested to yes/verified
+    """
+    if first[field] in ('N', 'R') and dupe[field] in ('Y', 'V'):
+        first[field] = dupe[field]
+    del dupe[field]
+
+
+_RE_RST_ANALOG = re.compile(r'\d\d\d')
+_RE_RST_DIGITAL = re.compile(r'[+-]\d\d')
+
+
+@merge_policy('RST_SENT', 'RST_RCVD')
+def merge_rst_digital(field, first, dupe):
+    """
+    Prefer +/- reports over 3-digit reports which were probably
+    generated by default by a non-digital logging program
+    """
+    if _RE_RST_ANALOG.match(first[field]) and _RE_RST_DIGITAL.match(dupe[field]):
+        first[field] = dupe[field]
+        del dupe[field]
+
+
+@merge_policy('DXCC', 'A_INDEX', 'K_INDEX', 'SFI', *FIELD_ZONES)
+def merge_zone_fill(field, first, dupe):
+    """
+    Fill in a missing (zero) value, otherwise leave the conflict alone
+    """
+    if dupe[field] and not first[field]:
+        first[field] = dupe[field]
+        del dupe[field]
+
+
+def merge_source_override(field, first, dupe):
+    """
+    If the field belongs to one of the SOURCE_OVERRIDES, take the value
+    from that source, or failing that keep what we have.
+    """
+    source = field_override_source(field)
+    if source:
+        if source in file_sources(dupe['_SOURCE_FILE']):
+            first[field] = dupe[field]
+        del dupe[field]
 
 
 def merge_dupe_fields(field, first, dupe):
@@ -248,69 +606,11 @@ def merge_dupe_fields(field, first, dupe):
     if first[field] == dupe[field]:
         del dupe[field]
         return
-    if field in ['NAME', 'MY_NAME', 'ADDRESS', 'MY_ADDRESS', 'STREET', 'MY_STREET',
-                 'CITY', 'MY_CITY', 'CNTY', 'MY_CNTY', 'STATE', 'MY_STATE',
-                 'COUNTRY', 'MY_COUNTRY',
-                 'MY_RIG', 'COMMENT', 'EMAIL', 'QSLMSG', 'WEB', 'PFX', 'QSL_VIA', 'QTH']:
-        fnslc = comparable_string(first[field])
-        dnslc = comparable_string(dupe[field])
-        # if dupe is identical but had whitespace, use the one with whitespace
-        # else use the longer one if one is a substring of the other
-        if fnslc == dnslc:
-            if len(first[field]) < len(dupe[field]) or first[field].isupper():
-                first[field] = dupe[field]
-            del dupe[field]
-        elif fnslc in dnslc:
-            first[field] = dupe[field]
-            del dupe[field]
-        elif dnslc in fnslc:
-            del dupe[field]
-    if field in ['TIME_ON', 'TIME_OFF', 'GRIDSQUARE']:
-        # handle the present but empty case
-        if not first[field]:
-            first[field] = dupe[field]
-            del dupe[field]
-        elif not dupe[field]:
-            del dupe[field]
-        elif first[field][0:4] == dupe[field][0:4]:
-            # chose the field with higher precision
-            if len(dupe[field]) > len(first[field]):
-                first[field] = dupe[field]
-                del dupe[field]
-            elif len(dupe[field]) <= len(first[field]):
-                del dupe[field]
-    if field in ['DISTANCE']:
-        # if the distance difference is less that 5 miles or 15%, choose the longer
-        difference = abs(first[field] - dupe[field])
-        if difference < MERGE_DISTANCE_ABS or difference / first[field] < MERGE_DISTANCE_PCT:
-            first[field] = max(first[field], dupe[field])
-            del dupe[field]
-    if field in ['FREQ', 'FREQ_RX']:
-        if abs(first[field] - dupe[field]) < 0.01:
-            first[field] = max(first[field], dupe[field])
-            del dupe[field]
-    if field in ['QSL_RCVD', 'QSL_SENT', 'EQSL_QSL_SENT', 'EQSL_QSL_RCVD',
-                 'LOTW_QSL_SENT', 'LOTW_QSL_RCVD', 'QSO_RANDOM']:
-        if first[field] in ['N', 'R'] and dupe[field] in ['Y', 'V']:
-            first[field] = dupe[field]
-        del dupe[field]
-    if field in ['RST_SENT', 'RST_RCVD']:
-        # prefer +/- reports over 3-digit reports which were probably
-        # generated by default by a non-digital logging program
-        if (re.match(r'\d\d\d', first[field]) and
-                re.match(r'[+-]\d\d', dupe[field])):
-            first[field] = dupe[field]
-            del dupe[field]
-    if field in ['DXCC', 'A_INDEX', 'K_INDEX', 'SFI'] + FIELD_ZONES:
-        if dupe[field] and not first[field]:
-            first[field] = dupe[field]
-            del dupe[field]
+    policy = MERGE_POLICIES.get(field)
+    if policy:
+        policy(field, first, dupe)
     if field in dupe:
-        for source, match in SOURCE_OVERRIDES.items():
-            if re.match(match, field):
-                if source in dupe['_SOURCE_FILE'].upper():
-                    first[field] = dupe[field]
-                del dupe[field]
+        merge_source_override(field, first, dupe)
 
 
 def merge_two_qsos(first, dupe):
@@ -332,110 +632,576 @@ def merge_two_qsos(first, dupe):
     return first
 
 
-def merge_qsos(qsos, window):
+def _cpu_time():
+    # including worker processes which have been waited for
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and its children in MB, if known
+    """
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS, KiB everywhere else
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _rss_growth(start):
+    # growth of the peak RSS since start, if known
+    return None if start is None else peak_rss_mb() - start
+
+
+class MergeStats:
+    """
+    Wall and CPU time per merge stage and how much each raised the peak
+    memory, plus counters of what each stage did.  Stages run more than
+    once (one per input file, for instance) accumulate.
+
+    The peak RSS is a high-water mark of the whole process, a stage that
+    reuses memory freed by an earlier one doesn't raise it.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+
+    def add(self, name, wall, cpu, rss_growth=None):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = stage = {'wall': 0.0, 'cpu': 0.0, 'peak_rss_growth_mb': None}
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        if rss_growth is not None:
+            stage['peak_rss_growth_mb'] = (stage['peak_rss_growth_mb'] or 0.0) + rss_growth
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def stage(self, name, exclude=None):
+        """
+        Time the enclosed block as stage name, less any time (and peak
+        memory growth) the block itself accounted to the stage exclude.
+        """
+        excluded = dict(self.stages.get(exclude, {'wall': 0.0, 'cpu': 0.0,
+                                                  'peak_rss_growth_mb': None}))
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        rss = peak_rss_mb()
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = _cpu_time() - cpu
+            rss_growth = _rss_growth(rss)
+            if exclude in self.stages:
+                wall -= self.stages[exclude]['wall'] - excluded['wall']
+                cpu -= self.stages[exclude]['cpu'] - excluded['cpu']
+                if rss_growth is not None:
+                    rss_growth -= ((self.stages[exclude]['peak_rss_growth_mb'] or 0.0) -
+                                   (excluded['peak_rss_growth_mb'] or 0.0))
+            self.add(name, wall, cpu, rss_growth)
+
+    def timed(self, name, iterable):
+        """
+        Yield from iterable, accounting the time spent (and peak memory
+        growth) producing each item to stage name.
+        """
+        wall = cpu = 0.0
+        rss_growth = None
+        iterator = iter(iterable)
+        try:
+            while True:
+                start_wall = time.perf_counter()
+                start_cpu = time.process_time()
+                start_rss = peak_rss_mb()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    wall += time.perf_counter() - start_wall
+                    cpu += time.process_time() - start_cpu
+                    if start_rss is not None:
+                        rss_growth = (rss_growth or 0.0) + _rss_growth(start_rss)
+                yield item
+        finally:
+            self.add(name, wall, cpu, rss_growth)
+
+    def as_dict(self):
+        return {
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'total': {
+                'wall': sum(stage['wall'] for stage in self.stages.values()),
+                'cpu': sum(stage['cpu'] for stage in self.stages.values()),
+            },
+            # of the whole process, the stages only tell how much they raised it
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def table(self):
+        """
+        The stats as a human readable table
+        """
+        def mb(value):
+            return "{:10.1f}".format(value) if value is not None else "{:>10s}".format("-")
+        lines = ["{:16s} {:>10s} {:>10s} {:>10s}".format("stage", "wall s", "cpu s", "+peak MB")]
+        for name, stage in self.stages.items():
+            lines.append("{:16s} {:10.3f} {:10.3f} {}".format(
+                name, stage['wall'], stage['cpu'], mb(stage['peak_rss_growth_mb'])))
+        total = self.as_dict()
+        lines.append("{:16s} {:10.3f} {:10.3f}".format(
+            "total", total['total']['wall'], total['total']['cpu']))
+        lines.append("{:38s} {}".format("peak MB", mb(total['peak_rss_mb'])))
+        lines.append("")
+        for name, value in sorted(self.counters.items()):
+            lines.append("{:16s} {:10d}".format(name, value))
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def stage(stats, name, exclude=None):
+    """
+    stats.stage(), if we are collecting stats at all
+    """
+    if stats is None:
+        yield None
+    else:
+        with stats.stage(name, exclude):
+            yield stats
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+# a century of QSO dates
+DATE_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _date_timestamp(date):
+    return (datetime(int(date[0:4]), int(date[4:6]), int(date[6:8])) - _EPOCH).days * 86400
+
+
+def qso_timestamp(qso):
     """
-    First bucketize all QSOs by unique fields, then chunk them off by time
+    QSO_DATE/TIME_ON as integer seconds since the epoch (UTC), cheap
+    enough to compute for every QSO.
+    """
+    time = qso['TIME_ON']
+    seconds = int(time[4:6]) if len(time) == 6 else 0
+    return (_date_timestamp(qso['QSO_DATE']) +
+            int(time[0:2]) * 3600 + int(time[2:4]) * 60 + seconds)
+
+
+def bucket_key(qso):
+    """
+    Only QSOs with the same call, band, mode and submode can be merged
+    """
+    return (qso['CALL'], qso['BAND'], qso.get('MODE'), qso.get('SUBMODE'))
+
+
+def merge_bucket(entries, window, on_problem=None):
+    """
+    Merge a time sorted list of (timestamp, qso) entries which share a
+    bucket key, anchoring each window on the first QSO in it.  Returns
+    the surviving (timestamp, qso) entries in time order.
+
+    on_problem is called with each QSO left with unmerged fields, as
+    soon as its window has closed.
+    """
+    merged = []
+    restamp = False
+    first = None
+    touched = False
+    for timestamp, qso in entries:
+        if first is not None and timestamp < cutoff:
+            merge_two_qsos(first, qso)
+            touched = True
+            continue
+        if touched:
+            restamp = True
+            _close_window(merged, first, on_problem)
+        first = qso
+        cutoff = timestamp + window
+        touched = False
+        merged.append((timestamp, qso))
+    if touched:
+        restamp = True
+        _close_window(merged, first, on_problem)
+    if restamp:
+        merged.sort(key=itemgetter(0))
+    return merged
+
+
+def _close_window(merged, first, on_problem):
+    # a more precise TIME_ON may have been merged into the anchor
+    merged[-1] = (qso_timestamp(first), first)
+    if on_problem is not None and '_UNMERGED' in first:
+        on_problem(first)
+
+
+def bucketize(qsos):
+    """
+    Group QSOs by bucket_key() into time sorted lists of (timestamp, qso)
     """
     buckets = {}
-    for qso in sorted(qsos, key=adif_io.time_on):
-        key = "{}_{}_{}_{}".format(qso['CALL'], qso['BAND'], qso.get('MODE'), qso.get('SUBMODE'))
-        if key not in buckets:
-            buckets[key] = []
-        buckets[key].append(qso)
+    for entry in sorted(((qso_timestamp(qso), qso) for qso in qsos), key=itemgetter(0)):
+        key = bucket_key(entry[1])
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = bucket = []
+        bucket.append(entry)
+    return buckets
 
-    # this depends upon sorted above
-    for entries in buckets.values():
-        first = entries[0]
-        cutoff = adif_io.time_on(first) + timedelta(seconds=window)
-        for qso in entries[1:]:
-            if adif_io.time_on(qso) < cutoff:
-                merge_two_qsos(first, qso)
-            else:
-                first = qso
-                cutoff = adif_io.time_on(first) + timedelta(seconds=window)
-
-    # remove any residual unmerged crap from the top list
-    for entry, values in buckets.items():
-        buckets[entry] = [qso for qso in values if 'CALL' in qso]
-
-    merged_qsos = []
+
+def _merge_qsos_numpy(qsos, window, on_problem, stats):
+    """
+    merge_qsos() with the window clustering vectorized: QSOs are sorted
+    once by bucket and time, and only runs of QSOs in a bucket less than
+    window apart go through merge_bucket(), every other QSO can't merge.
+    Gives the same result, and problems in the same order, as bucketize()
+    followed by merge_bucket() on every bucket.
+    """
+    with stage(stats, "bucketize"):
+        count = len(qsos)
+        codes = {}
+        raw_codes = numpy.fromiter(
+            (codes.setdefault(bucket_key(qso), len(codes)) for qso in qsos),
+            dtype=numpy.int64, count=count)
+        stamps = numpy.fromiter((qso_timestamp(qso) for qso in qsos),
+                                dtype=numpy.int64, count=count)
+        serials = numpy.arange(count)
+        # number buckets by their first QSO in time order, like bucketize()
+        _codes, firsts = numpy.unique(raw_codes[numpy.lexsort((serials, stamps))],
+                                      return_index=True)
+        ranks = numpy.empty(len(codes), dtype=numpy.int64)
+        ranks[numpy.argsort(firsts)] = numpy.arange(len(codes))
+        bucket_codes = ranks[raw_codes]
+        order = numpy.lexsort((serials, stamps, bucket_codes))
+        sorted_codes = bucket_codes[order]
+        sorted_stamps = stamps[order]
+        close = ((sorted_codes[1:] == sorted_codes[:-1]) &
+                 (numpy.diff(sorted_stamps) < window))
+        linked = numpy.concatenate(([False], close, [False]))
+        starts = numpy.flatnonzero(linked[1:] & ~linked[:-1])
+        ends = numpy.flatnonzero(linked[:-1] & ~linked[1:]) + 1
+        singles = numpy.flatnonzero(~(linked[1:] | linked[:-1]))
+
+    with stage(stats, "merge"):
+        indexes = order.tolist()
+        stamp_list = sorted_stamps.tolist()
+        run_positions = []
+        run_stamps = []
+        run_qsos = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            entries = [(stamp_list[position], qsos[indexes[position]])
+                       for position in range(start, end)]
+            for offset, (stamp, qso) in enumerate(merge_bucket(entries, window, on_problem)):
+                run_positions.append(start + offset)
+                run_stamps.append(stamp)
+                run_qsos.append(qso)
+        # ties in time keep bucket order, as heapq.merge() of the buckets does
+        positions = numpy.concatenate((singles, numpy.array(run_positions, dtype=numpy.int64)))
+        final_stamps = numpy.concatenate((sorted_stamps[singles],
+                                          numpy.array(run_stamps, dtype=numpy.int64)))
+        survivors = [qsos[index] for index in order[singles].tolist()] + run_qsos
+        merged = [survivors[index] for index in
+                  numpy.lexsort((positions, final_stamps)).tolist()]
+    return merged, len(codes)
+
+
+# more shards than workers keeps them all busy when bucket sizes vary
+MERGE_SHARDS_PER_JOB = 4
+
+# QSOs being merged, inherited by forked shard workers instead of pickled
+_shard_qsos = []
+
+
+def _merge_shard(shard, window):
+    """
+    Merge a shard of whole buckets, as (serial number, qso) pairs or just
+    serial numbers into _shard_qsos, in a worker process.  Returns the
+    number of buckets and the surviving QSOs keyed by (timestamp, bucket's
+    first timestamp and serial number, position in bucket), the order in
+    which merge_qsos() outputs them.
+    """
+    if _shard_qsos:
+        shard = [(serial, _shard_qsos[serial]) for serial in shard]
+    serials = {id(qso): serial for serial, qso in shard}
+    buckets = bucketize(qso for _serial, qso in shard)
+    merged = []
     for entries in buckets.values():
-        merged_qsos.extend(entries)
+        first = (entries[0][0], serials[id(entries[0][1])])
+        for position, (timestamp, qso) in enumerate(merge_bucket(entries, window)):
+            merged.append(((timestamp,) + first + (position,), qso))
+    merged.sort(key=itemgetter(0))
+    return len(buckets), merged
 
-    return sorted(merged_qsos, key=adif_io.time_on)
 
+def _merge_qsos_sharded(qsos, window, jobs, on_problem, stats):
+    """
+    merge_qsos() with the buckets hash-partitioned into shards that are
+    merged in jobs worker processes, then recombined in time order by a
+    k-way merge.  Problems are reported in time order once merged.
 
-def dump_problems(qsos, malformed, path):
+    Where worker processes can be forked they inherit the QSOs, and only
+    the merged QSOs have to be sent back.
+    """
+    global _shard_qsos
+    forked = "fork" in multiprocessing.get_all_start_methods()
+    shards = [[] for _ in range(jobs * MERGE_SHARDS_PER_JOB)]
+    with stage(stats, "bucketize"):
+        for serial, qso in enumerate(qsos):
+            shards[hash(bucket_key(qso)) % len(shards)].append(serial if forked else (serial, qso))
+    with stage(stats, "merge"):
+        if forked:
+            _shard_qsos = qsos
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=multiprocessing.get_context("fork") if forked else None) as executor:
+                results = list(executor.map(functools.partial(_merge_shard, window=window),
+                                            [shard for shard in shards if shard]))
+        finally:
+            _shard_qsos = []
+        merged = []
+        for _key, qso in heapq.merge(*[shard for _count, shard in results], key=itemgetter(0)):
+            if on_problem is not None and '_UNMERGED' in qso:
+                on_problem(qso)
+            merged.append(qso)
+    return merged, sum(count for count, _shard in results)
+
+
+def merge_qsos(qsos, window, on_problem=None, stats=None, jobs=1):
+    """
+    First bucketize all QSOs by unique fields, then chunk them off by time.
+    The clustering is done with NumPy if it's installed, or the buckets
+    are merged in jobs worker processes (0 is one per CPU).
+    """
+    if stats is not None:
+        report = on_problem
+
+        def on_problem(qso):
+            stats.count('problem_qsos')
+            stats.count('runts', len(qso['_UNMERGED']))
+            if report is not None:
+                report(qso)
+
+    if jobs != 1 and qsos:
+        merged, bucket_count = _merge_qsos_sharded(qsos, window, jobs or os.cpu_count(),
+                                                   on_problem, stats)
+    elif numpy is not None and qsos:
+        merged, bucket_count = _merge_qsos_numpy(qsos, window, on_problem, stats)
+    else:
+        with stage(stats, "bucketize"):
+            buckets = bucketize(qsos)
+        # buckets are merged in time order, so the result needs no re-sort
+        with stage(stats, "merge"):
+            merged = [merge_bucket(entries, window, on_problem) for entries in buckets.values()]
+            merged = [qso for _timestamp, qso in heapq.merge(*merged, key=itemgetter(0))]
+        bucket_count = len(buckets)
+    if stats is not None:
+        stats.count('buckets', bucket_count)
+        stats.count('merges', len(qsos) - len(merged))
+    return merged
+
+
+def qso_id(qso):
+    """
+    Human readable identifier for a QSO in reports
+    """
+    return "{}_{}_{}_{}".format(
+        qso.get('CALL'), qso.get('QSO_DATE'), qso.get('TIME_ON'), qso.get('BAND'))
+
+
+def problem_report(qsos, malformed):
     """
     Report any unmerged fields, break the problem report down both
-    by field, and by qso and output the report as a .json file
+    by field, and by qso.  Returns None if there were no problems.
     """
     problems = [qso for qso in qsos if '_UNMERGED' in qso]
     dupe_fields = {}
     for qso in problems:
         for source, dupe in qso['_UNMERGED'].items():
-            qso_id = "{}_{}_{}_{}".format(
-                qso['CALL'], qso['QSO_DATE'], qso['TIME_ON'], qso['BAND'])
+            problem_id = qso_id(qso)
             for field in dupe.keys():
                 if field not in dupe_fields:
                     dupe_fields[field] = {
                         'count': 0,
                         'qsos': {}
                     }
-                if qso_id not in dupe_fields[field]['qsos'].keys():
+                if problem_id not in dupe_fields[field]['qsos'].keys():
                     dupe_fields[field]['count'] += 1
-                    dupe_fields[field]['qsos'][qso_id] = {
+                    dupe_fields[field]['qsos'][problem_id] = {
                         '#SELECTED#': qso[field]
                     }
-                dupe_fields[field]['qsos'][qso_id][source] = dupe[field]
-    if problems or malformed:
-        report = {
-            'problems_by_field': dupe_fields,
-            'problems_by_qso': problems,
-            'malformed_qsos': malformed,
-        }
+                dupe_fields[field]['qsos'][problem_id][source] = dupe[field]
+    if not problems and not malformed:
+        return None
+    return {
+        'problems_by_field': dupe_fields,
+        'problems_by_qso': problems,
+        'malformed_qsos': list(malformed),
+    }
+
+
+def dump_problems(qsos, malformed, path):
+    """
+    Output the problem report as a .json file, if there are problems
+    """
+    report = problem_report(qsos, malformed)
+    if report is not None:
         with open(path, "w", encoding=ADIF_ENCODING) as wfd:
-            json.dump(report, wfd, indent=4, sort_keys=True)
+            json.dump(report, wfd, indent=4, sort_keys=True, default=dict)
 
 
-def adif_write_field(stream, field, entry, comment=""):
+class ProblemStream:
     """
-    Write a single field out for a QSO in <field:length>[data] format.
-    Separate them with spaces.
+    Write the problem report as JSON Lines while merging, one line per
+    malformed QSO and per unresolved conflict, finishing with a summary
+    line of per-field conflict counts.
+
+    Unless keep is set, the unmerged runts are dropped from each QSO
+    once reported so memory doesn't grow with the number of conflicts.
+    """
+    def __init__(self, stream, keep=False):
+        self.stream = stream
+        self.keep = keep
+        self.field_counts = Counter()
+        self.problem_count = 0
+        self.malformed_count = 0
+
+    def _write(self, line):
+        self.stream.write(json.dumps(line, sort_keys=True, default=dict))
+        self.stream.write("\n")
+
+    def malformed(self, qsos):
+        """
+        Report QSOs rejected upon load
+        """
+        for qso in qsos:
+            self._write({'type': 'malformed', 'qso': qso})
+        self.malformed_count += len(qsos)
+
+    def conflicts(self, qso):
+        """
+        Report the unmerged fields of a QSO, one line per source
+        """
+        unmerged = qso.get('_UNMERGED')
+        if not unmerged:
+            return
+        problem_id = qso_id(qso)
+        fields = set()
+        for source, dupe in unmerged.items():
+            self._write({
+                'type': 'conflict',
+                'qso': problem_id,
+                'source': source,
+                'fields': {field: {'#SELECTED#': qso.get(field), 'value': value}
+                           for field, value in dupe.items()},
+            })
+            fields.update(dupe.keys())
+        self.field_counts.update(fields)
+        self.problem_count += 1
+        if not self.keep:
+            del qso['_UNMERGED']
+
+    def close(self):
+        """
+        Write the summary line
+        """
+        self._write({
+            'type': 'summary',
+            'problem_qsos': self.problem_count,
+            'malformed_qsos': self.malformed_count,
+            'field_counts': dict(self.field_counts),
+        })
+
+
+# QSOs are written out in batches of this many records
+ADIF_WRITE_BATCH = 1000
+
+_FIELD_ORDER_SET = frozenset(FIELD_ORDER)
+_FIELD_ZONES_SET = frozenset(FIELD_ZONES)
+# field name -> "<field:" prefix
+_ADIF_TAGS = {}
+
+
+def adif_field(field, entry):
+    """
+    Format a single field in <field:length>[data] format.
     """
-    if field in FIELD_ZONES:
+    if field in _FIELD_ZONES_SET:
         entry = "{:02d}".format(int(entry))
     else:
         entry = str(entry)
+    tag = _ADIF_TAGS.get(field)
+    if tag is None:
+        tag = _ADIF_TAGS[field] = "<{}:".format(field.lower())
+    return tag + str(len(entry)) + ">" + entry
+
+
+def adif_write_field(stream, field, entry, comment=""):
+    """
+    Write a single field out for a QSO in <field:length>[data] format.
+    Separate them with spaces.
+    """
     if comment:
         comment = " //" + comment
-    print("<{}:{}>{}{}".format(field.lower(), len(entry), entry, comment),
-          file=stream, end=" ")
+    stream.write(adif_field(field, entry) + comment + " ")
+
+
+def adif_record(qso, minimal=False, newline="\n"):
+    """
+    Format a QSO as a single line of space separated fields, FIELD_ORDER
+    fields first and then anything else alphabetically.
+    """
+    fields = [adif_field(field, qso[field]) + " " for field in FIELD_ORDER if field in qso]
+    if not minimal:
+        fields.extend(adif_field(field, qso[field]) + " " for field in
+                      sorted(field for field in qso
+                             if field[0] != "_" and field not in _FIELD_ORDER_SET))
+    fields.append("<eor>" + newline)
+    return "".join(fields)
 
 
 def adif_write(stream, qsos, minimal=False):
     """
     Write an array of QSOs to an ADIF file stream with an ADIF compatible header.
+
+    Binary streams get ADIF_ENCODING bytes with platform line endings,
+    exactly as a text stream would have produced them.
     """
-    print("Created by {} version {} on {}".format(
-        __PROGRAM__, __VERSION__, datetime.utcnow()), file=stream)
-    adif_write_field(stream, "adif_ver", __STANDARD__)
-    adif_write_field(stream, "programid", __PROGRAM__)
-    adif_write_field(stream, "programversion", __VERSION__)
-    adif_write_field(stream, "created_timestamp",
-                     "{:%Y%m%d %H%M%S}".format(datetime.utcnow()))
-    print("<eoh>", file=stream)
+    if isinstance(stream, io.TextIOBase):
+        newline = "\n"
+        write = stream.write
+    else:
+        newline = os.linesep
+
+        def write(text):
+            stream.write(text.encode(ADIF_ENCODING))
+
+    write("".join([
+        "Created by {} version {} on {}".format(__PROGRAM__, __VERSION__, datetime.utcnow()),
+        newline,
+        adif_field("adif_ver", __STANDARD__), " ",
+        adif_field("programid", __PROGRAM__), " ",
+        adif_field("programversion", __VERSION__), " ",
+        adif_field("created_timestamp", "{:%Y%m%d %H%M%S}".format(datetime.utcnow())), " ",
+        "<eoh>", newline,
+    ]))
+    batch = []
     for qso in qsos:
-        for field in FIELD_ORDER:
-            if field in qso:
-                adif_write_field(stream, field, qso[field])
-        if not minimal:
-            for field in sorted(qso):
-                if field[0] == "_":
-                    continue
-                if field not in FIELD_ORDER:
-                    adif_write_field(stream, field, qso[field])
-        print("<eor>", file=stream)
+        batch.append(adif_record(qso, minimal, newline))
+        if len(batch) >= ADIF_WRITE_BATCH:
+            write("".join(batch))
+            batch = []
+    if batch:
+        write("".join(batch))
 
 
 def date_format_wsjt(native) -> str:
@@ -488,40 +1254,236 @@ def csv_write(csvfile, qsos) -> None:
         ])
 
 
-def read_adif_file(path) -> list:
+# <field:length[:type]> tags, plus the bare <eoh> and <eor> markers
+_ADIF_TAG = re.compile(rb'<(?:(eoh|eor)|(\w+):(\d+)(?::[^>]+)?)>', re.IGNORECASE)
+
+# field names are repeated in every record, share a single string for each
+_FIELD_NAMES = {}
+
+
+class ADIFReader:
+    """
+    Incremental ADIF tokenizer.
+
+    Raw bytes are fed in as they become available and each QSO is returned
+    as soon as its <eor> has been seen, so the whole file never needs to
+    be held in memory.  Field values are counted in bytes and decoded
+    one at a time, which lets us fall back from latin-1 to UTF-8 for a
+    single value without re-reading the file.
+    """
+    def __init__(self, path="", encoding=ADIF_ENCODING):
+        self.path = path
+        self.encoding = encoding
+        self.header = {}
+        self._buffer = b""
+        self._pos = 0
+        self._in_header = None
+        self._qso = {}
+        self._warned = False
+
+    def feed(self, data):
+        """
+        Add more raw input, return a list of QSOs completed by it.
+        """
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return self._parse(final=False)
+
+    def close(self):
+        """
+        Signal end of input, return any QSOs still pending.
+        """
+        qsos = self._parse(final=True)
+        if self._in_header:
+            raise ADIFFormatError("{}: <eoh> marker missing after ADIF header".format(self.path))
+        if self._qso:
+            logging.debug("%s: ignoring trailing fields without <eor>", self.path)
+            self._qso = {}
+        self._buffer = b""
+        self._pos = 0
+        return qsos
+
+    def _field_name(self, raw):
+        field = _FIELD_NAMES.get(raw)
+        if field is None:
+            field = sys.intern(raw.decode("ascii").upper())
+            _FIELD_NAMES[raw] = field
+        return field
+
+    def _decode(self, raw):
+        try:
+            return raw.decode(self.encoding)
+        except ValueError:
+            if not self._warned:
+                logging.warning("%s: failed to read using %s encoding, retrying as unicode",
+                                self.path, self.encoding)
+                self._warned = True
+            return raw.decode("utf-8")
+
+    def _parse(self, final):
+        buf = self._buffer
+        pos = self._pos
+        qsos = []
+        if self._in_header is None:
+            if not buf:
+                return qsos
+            # anything other than a tag up front means we have a header
+            self._in_header = buf[0:1] != b"<"
+        while True:
+            match = _ADIF_TAG.search(buf, pos)
+            if not match:
+                if final:
+                    pos = len(buf)
+                else:
+                    # hold on to a tag that may be split across two reads
+                    pos = max(pos, buf.rfind(b"<", pos))
+                break
+            marker, name, length = match.group(1, 2, 3)
+            if marker:
+                marker = marker.lower()
+                if self._in_header and marker == b"eoh":
+                    self._in_header = False
+                elif not self._in_header and marker == b"eor":
+                    qsos.append(self._qso)
+                    self._qso = {}
+                pos = match.end()
+                continue
+            start = match.end()
+            end = start + int(length)
+            if end > len(buf) and not final:
+                pos = match.start()
+                break
+            field = self._field_name(name)
+            value = self._decode(buf[start:end])
+            record = self.header if self._in_header else self._qso
+            if field in record:
+                raise ADIFFormatError("{}: duplicate field {} in {}".format(
+                    self.path, field, "header" if self._in_header else "QSO"))
+            if value:
+                record[field] = value
+            pos = end
+        self._pos = pos
+        return qsos
+
+
+def iter_adif_stream(stream, reader=None):
+    """
+    Yield the QSOs in a binary ADIF stream one at a time.
     """
-    Attempt to read and process an ADIF file and return all of the
-    QSO information.
+    if reader is None:
+        reader = ADIFReader(getattr(stream, "name", ""))
+    while True:
+        chunk = stream.read(ADIF_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield from reader.feed(chunk)
+    yield from reader.close()
+
+
+def iter_adif_file(path):
+    """
+    Yield the QSOs in an ADIF file one at a time.
 
     This is complicated by the fact that ADIF files are defined to be
     ascii only but nobody follows that convention, so they may be latin-1,
     windows cp1282, or unicode UTF-8 encoded.
     """
-    try:
-        with open(path, encoding=ADIF_ENCODING) as adif_file:
-            adif_string = adif_file.read()
-    except ValueError:
-        logging.warning("%s: failed to read using latin-1 encoding, retrying as unicode", path)
-        with open(path, encoding="utf-8") as adif_file:
-            adif_string = adif_file.read()
-    return adif_io.read_from_string(adif_string)
+    with open(path, "rb") as adif_file:
+        yield from iter_adif_stream(adif_file, ADIFReader(path))
 
 
-def read_adif_files(paths):
+def read_adif_file(path):
     """
-    Read in all ADIF records from the following files
+    Attempt to read an ADIF file and return all of the QSO information
+    along with the ADIF header.
+    """
+    reader = ADIFReader(path)
+    with open(path, "rb") as adif_file:
+        qsos = list(iter_adif_stream(adif_file, reader))
+    return qsos, reader.header
+
+
+def fixup_qsos(raw_qsos, filename, compact=False):
+    """
+    Fix up every raw QSO read from a single ADIF file.
+
+    Malformed QSOs are returned as (reason, qso) pairs rather than logged,
+    so that files loaded in worker processes are reported by the caller
+    in input order.
+    """
+    sources = file_sources(filename)
+    if sources:
+        logging.debug("%s: preferred source for %s fields", filename, ", ".join(sorted(sources)))
+    qsos = []
+    rejects = []
+    for qso in raw_qsos:
+        try:
+            qsos.append(fixup_qso(qso, filename, compact))
+        except QSOError as err:
+            rejects.append(err.args)
+    return qsos, rejects
+
+
+def load_adif_file(path, compact=False, stats=None):
+    """
+    Read and fix up every QSO in a single ADIF file.  Columnar logs
+    written by --columnar hold fixed up QSOs and are loaded as they are.
+    """
+    from adif_merge import columnar
+    if columnar.is_columnar_file(path):
+        with stage(stats, "columnar"):
+            return columnar.read_columnar(path, compact), []
+    if stats is None:
+        return fixup_qsos(iter_adif_file(path), os.path.basename(path), compact)
+    with stats.stage("fixup", exclude="parse"):
+        return fixup_qsos(stats.timed("parse", iter_adif_file(path)),
+                          os.path.basename(path), compact)
+
+
+def read_adif_files(paths, jobs=1, compact=False, cache=None, stats=None):
+    """
+    Read in all ADIF records from the following files, optionally
+    spreading the files across jobs worker processes (0 is one per CPU)
+    and storing them as compact QSORecords.  Files found in the parse
+    cache are not read at all.
+
+    When reading in worker processes, stats can only tell the time
+    spent reading in total, not parsing and fixing up separately.
     """
     qsos = []
     malformed = []
-    for path in paths:
-        filename = os.path.basename(path)
-        raw, _adif_header = read_adif_file(path)
-        for qso in raw:
-            try:
-                qsos.append(fixup_qso(qso, filename))
-            except QSOError as err:
-                logging.warning("Ignoring QSO: %s", err.args[0])
-                malformed.append(err.args[1])
+    with stage(stats, "cache"):
+        cached = [cache.get(path, compact) if cache else None for path in paths]
+    misses = [path for path, result in zip(paths, cached) if result is None]
+    executor = None
+    if jobs != 1 and len(misses) > 1:
+        load = functools.partial(load_adif_file, compact=compact)
+        executor = ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(misses)))
+        loaded = executor.map(load, misses)
+    else:
+        load = functools.partial(load_adif_file, compact=compact, stats=stats)
+        loaded = map(load, misses)
+    with stage(stats if executor else None, "read"):
+        try:
+            for path, result in zip(paths, cached):
+                if result is None:
+                    result = next(loaded)
+                    if cache:
+                        with stage(stats, "cache"):
+                            cache.put(path, result, compact)
+                file_qsos, rejects = result
+                for reason, qso in rejects:
+                    logging.warning("Ignoring QSO: %s", reason)
+                    malformed.append(qso)
+                qsos.extend(file_qsos)
+        finally:
+            if executor:
+                executor.shutdown()
+    if stats is not None:
+        stats.count('files', len(paths))
+        stats.count('cache_hits', len(paths) - len(misses))
+        stats.count('qsos', len(qsos))
+        stats.count('malformed', len(malformed))
     return qsos, malformed
 
 
@@ -539,19 +1501,164 @@ def filter_meta_fields(qsos, critical_only):
     return qsos
 
 
-def dump_qso_comparison(test_qsos, reference_qsos, compare_critical):
+def qso_fingerprint(qso):
+    """
+    Hashable, order independent form of a (filtered) QSO
+    """
+    return tuple(sorted(qso.items()))
+
+
+def multiset_difference(qsos, other_qsos):
     """
-    Compare the differences between qsos and previous run.
+    QSOs which are not matched by an identical QSO in other_qsos, each
+    match only being used once.  Keeps the original order.
+    """
+    remaining = Counter(map(qso_fingerprint, qsos))
+    remaining.subtract(map(qso_fingerprint, other_qsos))
+    difference = []
+    for qso in qsos:
+        fingerprint = qso_fingerprint(qso)
+        if remaining[fingerprint] > 0:
+            remaining[fingerprint] -= 1
+            difference.append(qso)
+    return difference
+
+
+def qso_changes(test_only, reference_only):
+    """
+    Pair up QSOs with the same CALL/QSO_DATE/TIME_ON/BAND from both sides
+    and report the fields that differ between them.
+    """
+    references = {}
+    for qso in reference_only:
+        references.setdefault(qso_id(qso), []).append(qso)
+    changes = []
+    for test in test_only:
+        candidates = references.get(qso_id(test))
+        if not candidates:
+            continue
+        reference = candidates.pop(0)
+        changes.append({
+            'qso': qso_id(test),
+            'fields': {
+                field: {'test': test.get(field), 'reference': reference.get(field)}
+                for field in sorted(set(test).union(reference))
+                if test.get(field) != reference.get(field)
+            },
+        })
+    return changes
+
+
+def dump_qso_comparison(test_qsos, reference_qsos, compare_critical,
+                        test_path="compare-1.json", reference_path="compare-2.json",
+                        changed_path="compare-changed.json"):
+    """
+    Compare the differences between qsos and previous run.  QSOs only
+    found in this run go to test_path, those only in the previous run to
+    reference_path, and the field by field differences for QSOs which
+    appear in both but were changed go to changed_path.
     """
     reference_qsos = filter_meta_fields(reference_qsos, compare_critical)
     test_qsos = filter_meta_fields(test_qsos, compare_critical)
-    reference_only = [qso for qso in reference_qsos if qso not in test_qsos]
-    test_only = [qso for qso in test_qsos if qso not in reference_qsos]
-    # XXX this is just a hack for now, we should really come up with a better encoding
-    with open("compare-1.json", "w", encoding=ADIF_ENCODING) as cfd:
-        json.dump(test_only, cfd, indent=4, sort_keys=True)
-    with open("compare-2.json", "w", encoding=ADIF_ENCODING) as cfd:
-        json.dump(reference_only, cfd, indent=4, sort_keys=True)
+    reference_only = multiset_difference(reference_qsos, test_qsos)
+    test_only = multiset_difference(test_qsos, reference_qsos)
+    changed = qso_changes(test_only, reference_only)
+    logging.info("Comparison: %d QSOs only in this run, %d only in the previous run, %d changed",
+                 len(test_only), len(reference_only), len(changed))
+    for path, report in [(test_path, test_only), (reference_path, reference_only),
+                         (changed_path, changed)]:
+        with open(path, "w", encoding=ADIF_ENCODING) as cfd:
+            json.dump(report, cfd, indent=4, sort_keys=True)
+
+
+MERGE_OPTIONS = {
+    'merge_window': MERGE_WINDOW,
+    'minimal': False,
+    'problems': False,
+    'wsjtx_log': False,
+    'compact': False,
+    'stats': False,
+}
+
+
+class MergeResult:
+    """
+    Outputs of merge() as bytes, ready to be served or written out.
+    The problem report and WSJT-X log are None unless requested, and the
+    problem report also when there were no problems.  stats is the
+    MergeStats.as_dict() of the merge if the stats option was set.
+    """
+    def __init__(self, adif, problems=None, wsjtx_log=None, qso_count=0, malformed_count=0,
+                 stats=None):
+        self.adif = adif
+        self.problems = problems
+        self.wsjtx_log = wsjtx_log
+        self.qso_count = qso_count
+        self.malformed_count = malformed_count
+        self.stats = stats
+
+
+def merge(streams, options=None):
+    """
+    Merge ADIF logs held in memory and return a MergeResult.
+
+    streams is a mapping, or an iterable of (name, data) pairs, where
+    data is bytes, a binary file-like object or an iterable of raw QSO
+    dicts as returned by ADIFReader.  The name is the log's original
+    file name, which decides which source is preferred for each field.
+    options overrides any of MERGE_OPTIONS.
+    """
+    merge_options = dict(MERGE_OPTIONS)
+    for option, value in (options or {}).items():
+        if option not in merge_options:
+            raise ValueError("Unknown merge option: {}".format(option))
+        merge_options[option] = value
+    if isinstance(streams, Mapping):
+        streams = streams.items()
+
+    stats = MergeStats() if merge_options['stats'] else None
+    qsos = []
+    malformed = []
+    for name, data in streams:
+        filename = os.path.basename(name)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.BytesIO(data)
+        if hasattr(data, "read"):
+            data = iter_adif_stream(data, ADIFReader(filename))
+            if stats is not None:
+                data = stats.timed("parse", data)
+        with stage(stats, "fixup", exclude="parse") as counters:
+            file_qsos, rejects = fixup_qsos(data, filename, merge_options['compact'])
+            if counters is not None:
+                counters.count('files')
+        for reason, qso in rejects:
+            logging.warning("Ignoring QSO: %s", reason)
+            malformed.append(qso)
+        qsos.extend(file_qsos)
+    if stats is not None:
+        stats.count('qsos', len(qsos))
+        stats.count('malformed', len(malformed))
+    qsos = merge_qsos(qsos, merge_options['merge_window'], stats=stats)
+
+    adif = io.BytesIO()
+    with stage(stats, "write_adif"):
+        adif_write(adif, qsos, merge_options['minimal'])
+    result = MergeResult(adif.getvalue(), qso_count=len(qsos), malformed_count=len(malformed))
+    if merge_options['problems']:
+        with stage(stats, "problems"):
+            report = problem_report(qsos, malformed)
+            if report is not None:
+                result.problems = json.dumps(
+                    report, indent=4, sort_keys=True, default=dict).encode(ADIF_ENCODING)
+    if merge_options['wsjtx_log']:
+        with stage(stats, "write_wsjtx"):
+            csvfile = io.StringIO()
+            csv_write(csvfile, qsos)
+            result.wsjtx_log = csvfile.getvalue().encode(ADIF_ENCODING)
+    if stats is not None:
+        stats.count('written', len(qsos))
+        result.stats = stats.as_dict()
+    return result
 
 
 def setup_logging(args):
@@ -561,26 +1668,154 @@ def setup_logging(args):
     logging.basicConfig(format='%(levelname)s: %(message)s', level=numeric_level)
 
 def process_adifs(args):
-    qsos, malformed = read_adif_files(args.input)
-    qsos = merge_qsos(qsos, args.merge_window)
+    """
+    Merge the input files as per the command line arguments, returns
+    the MergeStats if asked to collect them.
+    """
+    stats = MergeStats() if args.stats else None
+    cache = None
+    if args.cache_dir:
+        from adif_merge.cache import ParseCache
+        cache = ParseCache(args.cache_dir, args.cache_size * 1024 * 1024, args.cache_verify)
+
+    problem_stream = None
+    if args.problems_stream:
+        problem_stream = ProblemStream(open(args.problems_stream, "w", encoding=ADIF_ENCODING),
+                                       keep=bool(args.problems))
+    try:
+        if args.state:
+            from adif_merge.state import MergeState
+            with stage(stats, "state"):
+                state = MergeState.load(args.state, args.merge_window)
+                inputs = state.new_inputs(args.input)
+            qsos, malformed = read_adif_files([path for path, _digest in inputs],
+                                              args.jobs, args.compact, cache, stats)
+            with stage(stats, "merge"):
+                state.merge(qsos, malformed, inputs)
+            with stage(stats, "state"):
+                state.save(args.state)
+            qsos, malformed = state.qsos(), state.malformed
+            if stats is not None:
+                stats.count('buckets', len(state.buckets))
+                for qso in qsos:
+                    if '_UNMERGED' in qso:
+                        stats.count('problem_qsos')
+                        stats.count('runts', len(qso['_UNMERGED']))
+            if problem_stream:
+                problem_stream.malformed(malformed)
+                for qso in qsos:
+                    problem_stream.conflicts(qso)
+        elif args.logbook:
+            from adif_merge.logbook import Logbook
+            with stage(stats, "logbook"):
+                logbook = Logbook(args.logbook, args.merge_window)
+                inputs = logbook.new_inputs(args.input)
+            qsos, malformed = read_adif_files([path for path, _digest in inputs],
+                                              args.jobs, args.compact, cache, stats)
+            with stage(stats, "merge"):
+                logbook.merge(qsos, malformed, inputs)
+            # streamed from the logbook by each output in turn
+            qsos = logbook.qsos(args.since, args.until, args.band, args.unconfirmed)
+            malformed = logbook.malformed()
+            if problem_stream:
+                problem_stream.malformed(malformed)
+                for qso in qsos:
+                    problem_stream.conflicts(qso)
+        elif args.memory_budget:
+            from adif_merge.external import ExternalMerge
+            external = ExternalMerge(args.memory_budget * 1024 * 1024, args.spill_dir,
+                                     args.compact, stats)
+            external.read(args.input)
+            # streamed from the merged partitions by each output in turn
+            qsos, malformed = external.merge(args.merge_window), external.malformed
+            if problem_stream:
+                problem_stream.malformed(malformed)
+                for qso in qsos:
+                    problem_stream.conflicts(qso)
+        else:
+            qsos, malformed = read_adif_files(args.input, args.jobs, args.compact, cache, stats)
+            if problem_stream:
+                problem_stream.malformed(malformed)
+            qsos = merge_qsos(qsos, args.merge_window,
+                              problem_stream.conflicts if problem_stream else None, stats,
+                              args.merge_jobs)
+    finally:
+        if problem_stream:
+            problem_stream.close()
+            problem_stream.stream.close()
 
     if args.compare:
-        reference_qsos, _reference_malformed = read_adif_files([args.compare])
-        dump_qso_comparison(qsos, reference_qsos, args.compare_critical)
-        return
+        reference_qsos, _reference_malformed = read_adif_files([args.compare], compact=args.compact)
+        with stage(stats, "compare"):
+            dump_qso_comparison(qsos, reference_qsos, args.compare_critical,
+                                "{}-1.json".format(args.compare_output),
+                                "{}-2.json".format(args.compare_output),
+                                "{}-changed.json".format(args.compare_output))
+        return stats
 
     if args.problems:
-        dump_problems(qsos, malformed, args.problems)
+        with stage(stats, "problems"):
+            dump_problems(qsos, malformed, args.problems)
 
     if args.output:
         # ADIF files are supposed to be ascii, not unicode, unfortunately.
-        with open(args.output, "w", encoding=ADIF_ENCODING) as adiffile:
+        with stage(stats, "write_adif"), open(args.output, "wb") as adiffile:
             adif_write(adiffile, qsos, args.minimal)
 
     if args.wsjtx_log:
-        with open(args.wsjtx_log, "w", encoding=ADIF_ENCODING) as csvfile:
+        with stage(stats, "write_wsjtx"), open(args.wsjtx_log, "w", encoding=ADIF_ENCODING) as csvfile:
             csv_write(csvfile, qsos)
 
+    if args.columnar:
+        from adif_merge.columnar import write_columnar
+        with stage(stats, "write_columnar"):
+            write_columnar(args.columnar, qsos)
+
+    if stats is not None:
+        stats.count('written', len(qsos))
+    return stats
+
+
+def process_count(value):
+    """
+    argparse type for a number of processes, 0 meaning one per CPU
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise argparse.ArgumentTypeError(
+            "invalid process count: {!r} (0 for one per CPU)".format(value))
+    return count
+
+
+def memory_budget(value):
+    """
+    argparse type for a memory budget of at least 1 MB
+    """
+    try:
+        budget = int(value)
+    except ValueError:
+        budget = 0
+    if budget < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid memory budget: {!r} (MB, at least 1)".format(value))
+    return budget
+
+
+def adif_date(value):
+    """
+    argparse type for a date in ADIF's YYYYMMDD format
+    """
+    try:
+        if len(value) != 8 or not value.isdigit():
+            raise ValueError(value)
+        datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: {!r} (YYYYMMDD)".format(value))
+    return value
+
 
 def parse_args(inputs=None):
     parser = argparse.ArgumentParser(
@@ -588,27 +1823,75 @@ def parse_args(inputs=None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--problems', '-p', type=str,
                         help="Intermediate problem output .json")
+    parser.add_argument('--problems-stream', '-P', type=str,
+                        help="Stream problems as JSON Lines (.jsonl) while merging")
     parser.add_argument('--compare', '-c', type=str,
                         help="Merge ADIF files and only compare against previous run")
     parser.add_argument('--compare-critical', '-C', action='store_true',
                         help="When doing a comparison, only compare critical QSO fields")
+    parser.add_argument('--compare-output', type=str, default="compare",
+                        help="Comparison reports are written to <prefix>-1.json (only in "
+                             "this run), -2.json (only in previous run) and -changed.json")
     parser.add_argument('--output', '-o', type=str, default="qso_merged.adif",
                         help="Merged log output .adif")
     parser.add_argument('--minimal', '-m', action='store_true',
                         help="Only output important fields")
     parser.add_argument('--merge-window', type=int, default=MERGE_WINDOW,
                         help="Time window for merging discrepent log entries")
+    parser.add_argument('--jobs', '-j', type=process_count, default=1,
+                        help="Parse input files in this many processes (0 for one per CPU)")
+    parser.add_argument('--merge-jobs', type=process_count, default=1,
+                        help="Merge buckets of QSOs in this many processes (0 for one per CPU)")
+    parser.add_argument('--memory-budget', type=memory_budget,
+                        help="Merge out of core, keeping about this many MB of QSOs in memory "
+                             "and spilling the rest to disk")
+    parser.add_argument('--spill-dir', type=str,
+                        help="Directory for the temporary files of --memory-budget")
+    parser.add_argument('--compact', action='store_true',
+                        help="Store QSOs in compact records to merge very large logs")
+    parser.add_argument('--state', '-s', type=str,
+                        help="Incrementally merge new input files into this saved merge state")
+    parser.add_argument('--logbook', '-l', type=str,
+                        help="Merge new input files into this SQLite logbook and export from it")
+    parser.add_argument('--since', type=adif_date,
+                        help="Only export logbook QSOs from this date (YYYYMMDD) on")
+    parser.add_argument('--until', type=adif_date,
+                        help="Only export logbook QSOs up to this date (YYYYMMDD)")
+    parser.add_argument('--band', type=str,
+                        help="Only export logbook QSOs on this band")
+    parser.add_argument('--unconfirmed', action='store_true',
+                        help="Only export logbook QSOs not confirmed by any QSL")
+    parser.add_argument('--cache-dir', type=str,
+                        help="Cache parsed input files in this directory")
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help="Maximum size of the parse cache in MB")
+    parser.add_argument('--cache-verify', action='store_true',
+                        help="Also key the parse cache on a hash of each file's contents")
     parser.add_argument('--wsjtx-log', '-w', type=str,
                         help="WSJT-X compatible .log file")
+    parser.add_argument('--columnar', type=str,
+                        help="Merged log output in columnar format (.adicol, or .parquet "
+                             "with pyarrow), readable again as an input file")
+    parser.add_argument('--stats', choices=["table", "json"],
+                        help="Print time, memory and counts for each stage of the merge")
+    parser.add_argument('--profile', type=str,
+                        help="Profile the merge with cProfile and save the stats to this file")
     parser.add_argument('--log-level', type=str, default="info",
                         help="Log level for debugging")
     parser.add_argument('--version', '-v', action='version',
                         version="%(prog)s {version}".format(version=__VERSION__))
-    parser.add_argument('input', type=str, nargs="+",
-                        help="Input file list")
+    parser.add_argument('input', type=str, nargs="*",
+                        help="Input file list (may be empty to only export a --logbook)")
     if inputs is None:
         inputs = sys.argv[1:]
-    return parser.parse_args(inputs)
+    args = parser.parse_args(inputs)
+    if not args.input and not args.logbook:
+        parser.error("the following arguments are required: input")
+    if sum(bool(option) for option in (args.state, args.logbook, args.memory_budget)) > 1:
+        parser.error("only one of --state, --logbook and --memory-budget can be used")
+    if not args.logbook and (args.since or args.until or args.band or args.unconfirmed):
+        parser.error("--since, --until, --band and --unconfirmed only apply to a --logbook")
+    return args
 
 
 def main():
@@ -617,7 +1900,20 @@ def main():
     """
     args = parse_args()
     setup_logging(args)
-    process_adifs(args)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        stats = profiler.runcall(process_adifs, args)
+        profiler.dump_stats(args.profile)
+        logging.info("Profile saved to %s, see python3 -m pstats %s", args.profile, args.profile)
+    else:
+        stats = process_adifs(args)
+    if stats is not None:
+        if args.stats == "json":
+            json.dump(stats.as_dict(), sys.stdout, indent=4)
+            sys.stdout.write("\n")
+        else:
+            print(stats.table())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,403 @@
+"""
+Benchmark suite for adif_merge.
+
+Generates a realistic set of synthetic logs for the same station --
+a WSJT-X export, a LoTW download and a QRZ logbook export with its
+share of near duplicates -- then times each stage of a merge over them
+and prints the results as JSON, so runs can be compared across versions.
+
+    adif_merge_bench --count 100000 --output bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import adif_merge
+
+BENCH_START = datetime(2020, 1, 1)
+
+# (band, FT8 dial frequency in MHz, SSB/CW frequency in MHz)
+BENCH_BANDS = [
+    ("160m", 1.840, 1.850),
+    ("80m", 3.573, 3.750),
+    ("40m", 7.074, 7.200),
+    ("30m", 10.136, 10.110),
+    ("20m", 14.074, 14.250),
+    ("17m", 18.100, 18.130),
+    ("15m", 21.074, 21.300),
+    ("10m", 28.074, 28.400),
+    ("6m", 50.313, 50.150),
+]
+
+BENCH_PREFIXES = ["K", "W", "N", "AA", "KD", "VE3", "DL", "G", "JA", "VK", "PY", "EA", "I", "F"]
+BENCH_COUNTRIES = [
+    (291, "UNITED STATES OF AMERICA", 5, 8),
+    (1, "CANADA", 4, 9),
+    (230, "FEDERAL REPUBLIC OF GERMANY", 14, 28),
+    (223, "ENGLAND", 14, 27),
+    (339, "JAPAN", 25, 45),
+    (150, "AUSTRALIA", 30, 59),
+    (108, "BRAZIL", 11, 15),
+]
+BENCH_NAMES = ["JOHN", "Bob", "Hans-Peter", "Yuki", "Maria", "Ed", "Bill Smith"]
+BENCH_GRID_LETTERS = "ABCDEFGHIJKLMNOPQR"
+
+
+def synthetic_contact(rnd, timestamp):
+    """
+    The "true" QSO which the synthetic logs each record their own way
+    """
+    band, digital_freq, phone_freq = rnd.choice(BENCH_BANDS)
+    mode = rnd.choices(["FT8", "FT4", "SSB", "CW"], weights=[70, 10, 12, 8])[0]
+    if mode in ("FT8", "FT4"):
+        freq = digital_freq + rnd.randint(200, 2900) / 1e6
+        rst_sent, rst_rcvd = "{:+03d}".format(rnd.randint(-24, 10)), "{:+03d}".format(rnd.randint(-24, 10))
+    else:
+        freq = phone_freq + rnd.randint(0, 50) / 1e3
+        rst_sent, rst_rcvd = ("59", "57") if mode == "SSB" else ("599", "579")
+    return {
+        'timestamp': timestamp,
+        'call': "{}{}{}".format(rnd.choice(BENCH_PREFIXES), rnd.randint(0, 9),
+                                "".join(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+                                        for _ in range(rnd.randint(2, 3)))),
+        'band': band,
+        'mode': mode,
+        'freq': freq,
+        'grid': "{}{}{}{}{}{}".format(
+            rnd.choice(BENCH_GRID_LETTERS), rnd.choice(BENCH_GRID_LETTERS),
+            rnd.randint(0, 9), rnd.randint(0, 9),
+            rnd.choice("abcdefghijklmnopqrstuvwx"), rnd.choice("abcdefghijklmnopqrstuvwx")),
+        'rst_sent': rst_sent,
+        'rst_rcvd': rst_rcvd,
+        'country': rnd.choice(BENCH_COUNTRIES),
+        'name': rnd.choice(BENCH_NAMES),
+        'pwr': rnd.choice(["100", "50", "5", "1000"]),
+    }
+
+
+def synthetic_contacts(count, seed=1):
+    """
+    count contacts, a random 20s..5min apart
+    """
+    rnd = random.Random(seed)
+    timestamp = BENCH_START
+    contacts = []
+    for _ in range(count):
+        timestamp += timedelta(seconds=rnd.randint(20, 300))
+        contacts.append(synthetic_contact(rnd, timestamp))
+    return contacts
+
+
+def adif_text(fields, lower=False):
+    """
+    One ADIF record from (field, value) pairs
+    """
+    parts = []
+    for field, value in fields:
+        if value is None:
+            continue
+        value = str(value)
+        parts.append("<{}:{}>{}".format(field.lower() if lower else field, len(value), value))
+    parts.append("<eor>" if lower else "<EOR>")
+    return " ".join(parts) + "\n"
+
+
+def _adif_mode(contact):
+    # ADIF 3 puts FT4 and sideband under MFSK and SSB submodes
+    if contact['mode'] == "FT4":
+        return "MFSK", "FT4"
+    if contact['mode'] == "SSB":
+        return "SSB", "USB" if contact['freq'] > 10 else "LSB"
+    return contact['mode'], None
+
+
+def wsjtx_record(contact, rnd):
+    """
+    A QSO the way WSJT-X's wsjtx_log.adi records it
+    """
+    mode, submode = _adif_mode(contact)
+    end = contact['timestamp'] + timedelta(seconds=rnd.randint(30, 120))
+    return adif_text([
+        ('call', contact['call']),
+        ('gridsquare', contact['grid'][:4]),
+        ('mode', mode),
+        ('submode', submode),
+        ('rst_sent', contact['rst_sent']),
+        ('rst_rcvd', contact['rst_rcvd']),
+        ('qso_date', contact['timestamp'].strftime("%Y%m%d")),
+        ('time_on', contact['timestamp'].strftime("%H%M%S")),
+        ('qso_date_off', end.strftime("%Y%m%d")),
+        ('time_off', end.strftime("%H%M%S")),
+        ('band', contact['band']),
+        ('freq', "{:.6f}".format(contact['freq'])),
+        ('station_callsign', "N0CALL"),
+        ('my_gridsquare', "CM87"),
+        ('tx_pwr', contact['pwr']),
+        ('comment', "FT8  Sent: {} Rcvd: {}".format(contact['rst_sent'], contact['rst_rcvd'])
+         if contact['mode'] == "FT8" and rnd.random() < 0.2 else None),
+    ], lower=True)
+
+
+def lotw_record(contact, rnd):
+    """
+    A confirmed QSO the way a LoTW download reports it
+    """
+    mode, submode = _adif_mode(contact)
+    dxcc, country, cqz, ituz = contact['country']
+    confirmed = contact['timestamp'] + timedelta(days=rnd.randint(0, 60))
+    return adif_text([
+        ('APP_LoTW_OWNCALL', "N0CALL"),
+        ('STATION_CALLSIGN', "N0CALL"),
+        ('MY_DXCC', 291),
+        ('MY_COUNTRY', "UNITED STATES OF AMERICA"),
+        ('APP_LoTW_MY_DXCC_ENTITY_STATUS', "Current"),
+        ('MY_GRIDSQUARE', "CM87"),
+        ('CALL', contact['call']),
+        ('BAND', contact['band'].upper()),
+        ('FREQ', "{:.5f}".format(contact['freq'])),
+        ('MODE', mode),
+        ('SUBMODE', submode),
+        ('APP_LoTW_MODEGROUP', "DATA" if contact['mode'] in ("FT8", "FT4") else
+         "PHONE" if contact['mode'] == "SSB" else "CW"),
+        ('QSO_DATE', contact['timestamp'].strftime("%Y%m%d")),
+        ('APP_LoTW_QSO_TIMESTAMP', contact['timestamp'].strftime("%Y-%m-%dT%H:%M:%SZ")),
+        ('TIME_ON', contact['timestamp'].strftime("%H%M%S")),
+        ('QSL_RCVD', "Y"),
+        ('QSLRDATE', confirmed.strftime("%Y%m%d")),
+        ('APP_LoTW_RXQSL', confirmed.strftime("%Y-%m-%d %H:%M:%S")),
+        ('DXCC', dxcc),
+        ('COUNTRY', country),
+        ('APP_LoTW_DXCC_ENTITY_STATUS', "Current"),
+        ('GRIDSQUARE', contact['grid'][:4] if rnd.random() < 0.7 else None),
+        ('CQZ', "{:02d}".format(cqz)),
+        ('ITUZ', "{:02d}".format(ituz)),
+    ])
+
+
+def qrz_record(contact, rnd, shift=0):
+    """
+    A QSO the way a QRZ logbook export has it: start times that are
+    off by a little or truncated to the minute, and user-entered data
+    that doesn't always agree with the other logs
+    """
+    mode, submode = _adif_mode(contact)
+    dxcc, country, cqz, ituz = contact['country']
+    timestamp = contact['timestamp'] + timedelta(seconds=shift)
+    time_on = timestamp.strftime("%H%M" if rnd.random() < 0.3 else "%H%M%S")
+    return adif_text([
+        ('app_qrzlog_logid', rnd.randint(100000000, 999999999)),
+        ('app_qrzlog_status', "C" if rnd.random() < 0.5 else "N"),
+        ('band', contact['band']),
+        ('call', contact['call']),
+        ('cqz', cqz if rnd.random() < 0.9 else rnd.randint(1, 40)),
+        ('ituz', ituz),
+        ('country', country.title()),
+        ('dxcc', dxcc),
+        ('freq', "{:.3f}".format(contact['freq'])),
+        ('gridsquare', contact['grid'] if rnd.random() < 0.8 else contact['grid'][:4]),
+        ('mode', mode),
+        ('submode', submode),
+        ('name', contact['name']),
+        ('qso_date', timestamp.strftime("%Y%m%d")),
+        ('time_on', time_on),
+        ('rst_sent', contact['rst_sent'] if rnd.random() < 0.9 else "599"),
+        ('rst_rcvd', contact['rst_rcvd']),
+        ('tx_pwr', "{}W".format(contact['pwr']) if rnd.random() < 0.5 else contact['pwr']),
+        ('station_callsign', "N0CALL"),
+        ('my_gridsquare', "CM87"),
+    ], lower=True)
+
+
+def generate_logs(directory, count, seed=1, duplicates=0.05):
+    """
+    Write wsjtx_log.adi, lotw_log.adi and qrz_log.adi for count synthetic
+    contacts to directory, returning their paths.  The QRZ export also
+    has duplicates fraction of its QSOs logged twice inside MERGE_WINDOW.
+    """
+    rnd = random.Random(seed)
+    contacts = synthetic_contacts(count, seed)
+    paths = [os.path.join(directory, name) for name in
+             ("wsjtx_log.adi", "lotw_log.adi", "qrz_log.adi")]
+    with open(paths[0], "w", encoding=adif_merge.ADIF_ENCODING) as wsjtx, \
+            open(paths[1], "w", encoding=adif_merge.ADIF_ENCODING) as lotw, \
+            open(paths[2], "w", encoding=adif_merge.ADIF_ENCODING) as qrz:
+        wsjtx.write("WSJT-X ADIF Export<eoh>\n")
+        lotw.write("ARRL Logbook of the World Status Report\n"
+                   "Generated by adif_merge_bench\n\n"
+                   "<PROGRAMID:4>LoTW\n<APP_LoTW_NUMREC:{}>{}\n\n<eoh>\n".format(
+                       len(str(count)), count))
+        qrz.write("QRZ Logbook export for N0CALL\n<adif_ver:5>3.1.1 <programid:3>QRZ <eoh>\n")
+        for contact in contacts:
+            if contact['mode'] in ("FT8", "FT4"):
+                wsjtx.write(wsjtx_record(contact, rnd))
+            if rnd.random() < 0.6:
+                lotw.write(lotw_record(contact, rnd))
+            if rnd.random() < 0.95:
+                qrz.write(qrz_record(contact, rnd, rnd.randint(-30, 30)))
+                if rnd.random() < duplicates:
+                    qrz.write(qrz_record(contact, rnd, rnd.randint(10, adif_merge.MERGE_WINDOW - 10)))
+    return paths
+
+
+def iter_synthetic_qsos(count, seed=1, directory=None):
+    """
+    Yield (file name, raw QSO) for every record in the synthetic logs of
+    count contacts, written to a temporary directory and read back
+    """
+    with tempfile.TemporaryDirectory(prefix="adif_merge_bench", dir=directory) as logdir:
+        for path in generate_logs(logdir, count, seed):
+            filename = os.path.basename(path)
+            for qso in adif_merge.iter_adif_file(path):
+                yield filename, qso
+
+
+class StageTimer:
+    """
+    Collects wall and CPU time of each benchmark stage
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, stage, func, *args):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = func(*args)
+        self.stages[stage] = {
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+        }
+        return result
+
+
+def bench_merge(paths, workdir, window=adif_merge.MERGE_WINDOW):
+    """
+    Time each merge stage over the input files, returns (stages, counts)
+    """
+    timer = StageTimer()
+    raw = timer.run("read_adif_file", lambda: [
+        (os.path.basename(path), adif_merge.read_adif_file(path)[0]) for path in paths])
+
+    def fixup():
+        qsos = []
+        malformed = []
+        for filename, file_qsos in raw:
+            for qso in file_qsos:
+                try:
+                    qsos.append(adif_merge.fixup_qso(qso, filename))
+                except adif_merge.QSOError as err:
+                    malformed.append(err.args[1])
+        return qsos, malformed
+    qsos, malformed = timer.run("fixup_qso", fixup)
+    merged = timer.run("merge_qsos", adif_merge.merge_qsos, qsos, window)
+    timer.run("dump_problems", adif_merge.dump_problems, merged, malformed,
+              os.path.join(workdir, "problems.json"))
+
+    def write_adif():
+        with open(os.path.join(workdir, "merged.adi"), "wb") as adiffile:
+            adif_merge.adif_write(adiffile, merged)
+    timer.run("adif_write", write_adif)
+
+    def write_csv():
+        with open(os.path.join(workdir, "wsjtx.log"), "w", encoding=adif_merge.ADIF_ENCODING) as csvfile:
+            adif_merge.csv_write(csvfile, merged)
+    timer.run("csv_write", write_csv)
+
+    counts = {
+        'read': sum(len(file_qsos) for _filename, file_qsos in raw),
+        'malformed': len(malformed),
+        'merged': len(merged),
+        'problems': sum(1 for qso in merged if '_UNMERGED' in qso),
+    }
+    return timer.stages, counts
+
+
+def run_benchmark(count, seed=1, repeat=3, directory=None, window=adif_merge.MERGE_WINDOW):
+    """
+    Generate logs for count contacts and benchmark merging them, the best
+    of repeat runs is reported for each stage.  Returns the report dict.
+    """
+    with tempfile.TemporaryDirectory(prefix="adif_merge_bench") as workdir:
+        logdir = directory or workdir
+        os.makedirs(logdir, exist_ok=True)
+        start = time.perf_counter()
+        paths = generate_logs(logdir, count, seed)
+        generate = time.perf_counter() - start
+        input_bytes = sum(os.path.getsize(path) for path in paths)
+        best = {}
+        for _ in range(repeat):
+            stages, counts = bench_merge(paths, workdir, window)
+            for stage, times in stages.items():
+                if stage not in best or times['wall'] < best[stage]['wall']:
+                    best[stage] = times
+    for times in best.values():
+        times['qsos_per_second'] = counts['read'] / times['wall'] if times['wall'] else None
+    return {
+        'program': adif_merge.__PROGRAM__,
+        'version': adif_merge.__VERSION__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'contacts': count,
+        'seed': seed,
+        'repeat': repeat,
+        'merge_window': window,
+        'generate': generate,
+        'input_bytes': input_bytes,
+        'counts': counts,
+        'stages': best,
+        'total': {
+            'wall': sum(times['wall'] for times in best.values()),
+            'cpu': sum(times['cpu'] for times in best.values()),
+        },
+    }
+
+
+def parse_args(inputs=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark adif_merge over synthetic logs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--count', '-n', type=int, default=20000,
+                        help="Number of synthetic contacts")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Random seed for the synthetic logs")
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help="Report the best of this many runs of each stage")
+    parser.add_argument('--merge-window', type=int, default=adif_merge.MERGE_WINDOW,
+                        help="Time window for merging discrepent log entries")
+    parser.add_argument('--logs', type=str,
+                        help="Keep the generated logs in this directory")
+    parser.add_argument('--output', '-o', type=str,
+                        help="Write the JSON report here instead of to stdout")
+    parser.add_argument('--log-level', type=str, default="error",
+                        help="Log level for debugging")
+    if inputs is None:
+        inputs = sys.argv[1:]
+    return parser.parse_args(inputs)
+
+
+def main():
+    """
+    Run the benchmark and print its JSON report
+    """
+    args = parse_args()
+    adif_merge.setup_logging(args)
+    logging.info("Benchmarking %d contacts", args.count)
+    report = run_benchmark(args.count, args.seed, args.repeat, args.logs, args.merge_window)
+    if args.output:
+        with open(args.output, "w") as wfd:
+            json.dump(report, wfd, indent=4, sort_keys=True)
+            wfd.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+On-disk cache of parsed and fixed up ADIF files.
+
+Entries are keyed on the file's path, size and modification time (and
+optionally a hash of its contents), hold exactly what load_adif_file()
+returns, and are evicted least recently used first once the cache
+directory grows beyond its size limit.
+"""
+import hashlib
+import logging
+import os
+import pickle
+
+from adif_merge import __VERSION__
+
+CACHE_SUFFIX = ".adifcache"
+
+
+class ParseCache:
+    """
+    LRU cache of load_adif_file() results in a local directory, recency
+    is tracked through each entry's modification time.
+    """
+    def __init__(self, directory, max_bytes, verify=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verify = verify
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, path, compact):
+        stat = os.stat(path)
+        key = hashlib.sha256("{}\0{}\0{}\0{}\0{}".format(
+            __VERSION__, os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+            compact).encode("utf-8"))
+        if self.verify:
+            with open(path, "rb") as rfd:
+                for chunk in iter(lambda: rfd.read(1024 * 1024), b""):
+                    key.update(chunk)
+        return os.path.join(self.directory, key.hexdigest() + CACHE_SUFFIX)
+
+    def get(self, path, compact=False):
+        """
+        Return the cached (qsos, rejects) for path, or None.
+        """
+        entry = self._entry(path, compact)
+        try:
+            with open(entry, "rb") as rfd:
+                result = pickle.load(rfd)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as err:
+            logging.warning("%s: discarding unreadable cache entry: %s", entry, err)
+            self._remove(entry)
+            return None
+        os.utime(entry)
+        logging.info("%s: parse cache hit", path)
+        return result
+
+    def put(self, path, result, compact=False):
+        """
+        Cache the load_adif_file() result for path, then trim the cache.
+        """
+        entry = self._entry(path, compact)
+        tmp_entry = entry + ".tmp"
+        with open(tmp_entry, "wb") as wfd:
+            pickle.dump(result, wfd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until we fit in max_bytes.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for dirent in scan:
+                if dirent.name.endswith(CACHE_SUFFIX):
+                    stat = dirent.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, dirent.path))
+                    total += stat.st_size
+        entries.sort()
+        for _mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            logging.debug("%s: evicting from parse cache", entry)
+            self._remove(entry)
+            total -= size
+
+    @staticmethod
+    def _remove(entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
@@ -0,0 +1,273 @@
+"""
+Columnar export and import of merged logs.
+
+A merged log is stored column by column with typed columns for the
+ADIF Integer and Number fields, so that reading it back is a matter of
+decompressing a few arrays instead of tokenizing ADIF text, and the
+QSOs it holds are already fixed up.
+
+The native format is pure Python: an ADIFCOL magic, a JSON header and
+one zlib compressed array (or UTF-8 text blob) per column.  Files named
+*.parquet are written and read with pyarrow instead, if it's installed.
+"""
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from adif_merge import (
+    __PROGRAM__, __VERSION__, FIELD_INTEGERS, FIELD_INTEGERS_POS, FIELD_NUMBERS, FIELD_ORDER,
+    QSORecord)
+
+COLUMNAR_MAGIC = b"ADIFCOL\x01"
+COLUMNAR_VERSION = 1
+PARQUET_MAGIC = b"PAR1"
+
+_INTEGER_FIELDS = frozenset(FIELD_INTEGERS + FIELD_INTEGERS_POS)
+_NUMBER_FIELDS = frozenset(FIELD_NUMBERS)
+# fixup_qso() keeps whole Numbers as ints, except for the frequency
+_FLOAT_FIELDS = frozenset(['FREQ'])
+_INTERN_LEN = 8
+
+
+def _number_type(field):
+    return float if field in _FLOAT_FIELDS else None
+
+
+def _column_type(field, values):
+    """
+    Typed column for ADIF Integers and Numbers, as long as every value
+    round-trips exactly, text for everything else
+    """
+    present = [value for value in values if value is not None]
+    if field in _INTEGER_FIELDS:
+        if all(type(value) is int for value in present):
+            return "int"
+    elif field in _NUMBER_FIELDS:
+        if field in _FLOAT_FIELDS:
+            if all(type(value) is float for value in present):
+                return "float"
+        elif all(type(value) is int or (type(value) is float and not value.is_integer())
+                 for value in present):
+            return "float"
+    return "str"
+
+
+def _columns(qsos):
+    """
+    The number of QSOs and (field, values) of every field adif_write()
+    would output, in its order, None where a QSO lacks the field.
+
+    qsos is only iterated over once, as it may be streamed from a
+    logbook or an external merge.
+    """
+    columns = {}
+    count = 0
+    for count, qso in enumerate(qsos, 1):
+        for field, value in qso.items():
+            if field[0] == "_":
+                continue
+            column = columns.get(field)
+            if column is None:
+                columns[field] = column = []
+            if len(column) < count - 1:
+                column.extend([None] * (count - 1 - len(column)))
+            column.append(value)
+    for column in columns.values():
+        column.extend([None] * (count - len(column)))
+    extra = sorted(field for field in columns if field not in FIELD_ORDER)
+    fields = [field for field in FIELD_ORDER if field in columns] + extra
+    return count, [(field, columns[field]) for field in fields]
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _encode_column(kind, values):
+    """
+    Compressed parts of a column: validity mask and values for numbers,
+    character lengths (-1 if missing) and text for strings
+    """
+    if kind == "str":
+        lengths = array('q')
+        texts = []
+        for value in values:
+            if value is None:
+                lengths.append(-1)
+            else:
+                value = str(value)
+                lengths.append(len(value))
+                texts.append(value)
+        return [_little_endian(lengths), "".join(texts).encode("utf-8")]
+    mask = bytes(value is not None for value in values)
+    data = array('q' if kind == "int" else 'd',
+                 (0 if value is None else value for value in values))
+    return [mask, _little_endian(data)]
+
+
+def _decode_column(kind, field, parts):
+    """
+    The values of a column, None where missing
+    """
+    if kind == "str":
+        lengths = _from_little_endian('q', parts[0])
+        text = parts[1].decode("utf-8")
+        interned = {}
+        values = []
+        offset = 0
+        for length in lengths:
+            if length < 0:
+                values.append(None)
+                continue
+            value = text[offset:offset + length]
+            offset += length
+            if length <= _INTERN_LEN:
+                value = interned.setdefault(value, value)
+            values.append(value)
+        return values
+    mask = parts[0]
+    data = _from_little_endian('q' if kind == "int" else 'd', parts[1])
+    if kind == "float" and _number_type(field) is not float:
+        data = [int(value) if value.is_integer() else value for value in data]
+    return [value if present else None for value, present in zip(data, mask)]
+
+
+def _rows(columns, count, filename, compact):
+    """
+    Build QSOs from (field, values) columns
+    """
+    qsos = [QSORecord() if compact else {} for _ in range(count)]
+    for field, values in columns:
+        for qso, value in zip(qsos, values):
+            if value is not None:
+                qso[field] = value
+    for qso in qsos:
+        qso['_SOURCE_FILE'] = filename
+    return qsos
+
+
+def write_columnar(path, qsos):
+    """
+    Write merged QSOs to path in the native columnar format, or as
+    Parquet if path ends in .parquet
+    """
+    if path.lower().endswith(".parquet"):
+        write_parquet(path, qsos)
+        return
+    count, fields = _columns(qsos)
+    columns = []
+    blobs = []
+    for field, values in fields:
+        kind = _column_type(field, values)
+        parts = [zlib.compress(part, 6) for part in _encode_column(kind, values)]
+        columns.append({'name': field, 'type': kind, 'sizes': [len(part) for part in parts]})
+        blobs.extend(parts)
+    header = json.dumps({
+        'version': COLUMNAR_VERSION,
+        'program': __PROGRAM__,
+        'program_version': __VERSION__,
+        'rows': count,
+        'columns': columns,
+    }).encode("utf-8")
+    with open(path, "wb") as wfd:
+        wfd.write(COLUMNAR_MAGIC)
+        wfd.write(struct.pack("<I", len(header)))
+        wfd.write(header)
+        for blob in blobs:
+            wfd.write(blob)
+
+
+def read_columnar(path, compact=False):
+    """
+    Read QSOs back from a columnar file, setting only their _SOURCE_FILE
+    """
+    with open(path, "rb") as rfd:
+        magic = rfd.read(len(COLUMNAR_MAGIC))
+        if magic[:len(PARQUET_MAGIC)] == PARQUET_MAGIC:
+            return read_parquet(path, compact)
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError("{}: not a columnar log".format(path))
+        (length,) = struct.unpack("<I", rfd.read(4))
+        header = json.loads(rfd.read(length).decode("utf-8"))
+        if header.get('version') != COLUMNAR_VERSION:
+            raise ValueError("{}: unsupported columnar log version {}".format(
+                path, header.get('version')))
+        columns = []
+        for column in header['columns']:
+            parts = [zlib.decompress(rfd.read(size)) for size in column['sizes']]
+            columns.append((column['name'], _decode_column(column['type'], column['name'], parts)))
+    return _rows(columns, header['rows'], os.path.basename(path), compact)
+
+
+def is_columnar_file(path):
+    """
+    Whether path holds a columnar log (native or Parquet) rather than ADIF
+    """
+    with open(path, "rb") as rfd:
+        magic = rfd.read(len(COLUMNAR_MAGIC))
+    return magic == COLUMNAR_MAGIC or magic[:len(PARQUET_MAGIC)] == PARQUET_MAGIC
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as err:
+        raise ImportError("Parquet logs need pyarrow (pip install adif_merge[parquet]), "
+                          "or use the native .adicol format") from err
+    return pyarrow, pyarrow.parquet
+
+
+def write_parquet(path, qsos):
+    """
+    Write merged QSOs to a Parquet file with pyarrow
+    """
+    pyarrow, parquet = _pyarrow()
+    arrays = {}
+    for field, values in _columns(qsos)[1]:
+        kind = _column_type(field, values)
+        if kind == "int":
+            arrays[field] = pyarrow.array(values, type=pyarrow.int64())
+        elif kind == "float":
+            arrays[field] = pyarrow.array(
+                [None if value is None else float(value) for value in values],
+                type=pyarrow.float64())
+        else:
+            arrays[field] = pyarrow.array(
+                [None if value is None else str(value) for value in values],
+                type=pyarrow.string())
+    table = pyarrow.table(arrays)
+    table = table.replace_schema_metadata({
+        b'program': __PROGRAM__.encode("utf-8"),
+        b'program_version': __VERSION__.encode("utf-8"),
+    })
+    parquet.write_table(table, path)
+
+
+def read_parquet(path, compact=False):
+    """
+    Read QSOs back from a Parquet file written by write_parquet()
+    """
+    pyarrow, parquet = _pyarrow()
+    table = parquet.read_table(path)
+    columns = []
+    for field, column in zip(table.column_names, table.columns):
+        values = column.to_pylist()
+        if pyarrow.types.is_floating(column.type) and _number_type(field) is not float:
+            values = [value if value is None or not value.is_integer() else int(value)
+                      for value in values]
+        columns.append((field, values))
+    return _rows(columns, table.num_rows, os.path.basename(path), compact)
@@ -0,0 +1,313 @@
+"""
+External-memory merge for logs larger than the memory available.
+
+QSOs are read one at a time and buffered up to a memory budget, then
+spilled to a run file sorted by (hash slot of the bucket key, time,
+serial number), with the offset of every slot in it.  Once everything
+is read the slots are grouped into partitions that fit the budget, and
+each partition is loaded from all the runs, merged like merge_qsos()
+does and written out as a sorted result file, in chunks sized so that
+the result files can be merged within the budget.  The merged log is a
+k-way merge of the result files, streamed to the outputs, after merging
+them in passes of MERGE_FAN_IN files if there are more than that.
+
+The result is the same as merge_qsos() over all QSOs at once.  Memory
+use is estimated, so the budget is approximate.
+"""
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from operator import itemgetter
+
+from adif_merge import (
+    QSOError, bucket_key, fixup_qso, iter_adif_file, merge_bucket, qso_timestamp, stage)
+
+# bucket keys are hashed into this many slots, which are then grouped
+# into partitions, so a bucket is never split across partitions
+SPILL_SLOTS = 4096
+
+# a partition may use this share of the budget, merging it needs the rest,
+# which is also what the result files being merged may use
+PARTITION_SHARE = 0.5
+
+# at most this many result files are merged at once, more are first
+# merged in passes of this many
+MERGE_FAN_IN = 64
+
+
+def qso_size(qso):
+    """
+    Rough estimate of the memory taken by a QSO (a dict or QSORecord)
+    """
+    return sys.getsizeof(qso) + sum(map(sys.getsizeof, qso.values()))
+
+
+def _iter_result(path):
+    with open(path, "rb") as rfd:
+        while True:
+            try:
+                chunk = pickle.load(rfd)
+            except EOFError:
+                return
+            yield from chunk
+
+
+def _merge_results(results):
+    """
+    k-way merge of the keyed QSOs in the result files
+    """
+    return heapq.merge(*[_iter_result(result[0]) for result in results], key=itemgetter(0))
+
+
+class SpilledQSOs:
+    """
+    QSOs appended to a file as they come, streamed back from it each
+    time they're iterated over
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def append(self, qso):
+        with open(self.path, "ab") as wfd:
+            pickle.dump([qso], wfd, protocol=pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def __iter__(self):
+        if self.count:
+            yield from _iter_result(self.path)
+
+    def __len__(self):
+        return self.count
+
+
+class ExternalResult:
+    """
+    The merged QSOs in time order, streamed from the result files each
+    time they're iterated over
+    """
+    def __init__(self, merge, results, count):
+        # keeps the temporary directory alive as long as we are
+        self.merge = merge
+        self.results = results
+        self.count = count
+
+    def __iter__(self):
+        for _key, qso in _merge_results(self.results):
+            yield qso
+
+    def __len__(self):
+        return self.count
+
+
+class ExternalMerge:
+    """
+    Spill parsed QSOs to sorted runs on disk, then merge them partition
+    by partition within about budget bytes of memory.
+    """
+    def __init__(self, budget, directory=None, compact=False, stats=None):
+        self.budget = budget
+        self.compact = compact
+        self.stats = stats
+        self.directory = tempfile.TemporaryDirectory(prefix="adif_merge-", dir=directory)
+        self.runs = []
+        self.slot_sizes = [0] * SPILL_SLOTS
+        # spilled as well, so they don't count against the budget
+        self.malformed = SpilledQSOs(self._path("malformed"))
+        self.serial = 0
+        self.buffer = []
+        self.buffered = 0
+        self.result_files = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def _write_result(self, records, size, count, readers):
+        """
+        Write count keyed QSOs of about size bytes to a result file, in
+        chunks small enough for readers files to be merged at once within
+        the budget.  Returns (path, size, count).
+        """
+        chunk = max(1, int(self.budget * (1 - PARTITION_SHARE) / readers / (size / max(count, 1))))
+        path = self._path("result{}".format(self.result_files))
+        self.result_files += 1
+        with open(path, "wb") as wfd:
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= chunk:
+                    pickle.dump(batch, wfd, protocol=pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            if batch:
+                pickle.dump(batch, wfd, protocol=pickle.HIGHEST_PROTOCOL)
+        return path, size, count
+
+    def _reduce(self, results):
+        """
+        Merge result files in passes of MERGE_FAN_IN until no more than
+        that many are left, so they can all be open and read at once
+        """
+        while len(results) > MERGE_FAN_IN:
+            merged = []
+            for index in range(0, len(results), MERGE_FAN_IN):
+                group = results[index:index + MERGE_FAN_IN]
+                merged.append(self._write_result(
+                    _merge_results(group), sum(result[1] for result in group),
+                    sum(result[2] for result in group), MERGE_FAN_IN))
+                for path, _size, _count in group:
+                    os.remove(path)
+            results = merged
+            if self.stats is not None:
+                self.stats.count('merge_passes')
+        return results
+
+    def add(self, qso):
+        """
+        Buffer a fixed up QSO, spilling the buffer once over budget
+        """
+        size = qso_size(qso)
+        slot = hash(bucket_key(qso)) % SPILL_SLOTS
+        self.slot_sizes[slot] += size
+        self.buffer.append((slot, qso_timestamp(qso), self.serial, qso))
+        self.serial += 1
+        self.buffered += size
+        if self.buffered >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the buffer out as a run sorted by slot, time and serial
+        number, remembering where each slot starts
+        """
+        if not self.buffer:
+            return
+        with stage(self.stats, "spill"):
+            self.buffer.sort(key=itemgetter(0, 1, 2))
+            path = self._path("run{}".format(len(self.runs)))
+            offsets = {}
+            with open(path, "wb") as wfd:
+                for slot, records in itertools.groupby(self.buffer, key=itemgetter(0)):
+                    offsets[slot] = wfd.tell()
+                    pickle.dump([record[1:] for record in records], wfd,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+            self.runs.append((path, offsets))
+            self.buffer = []
+            self.buffered = 0
+        if self.stats is not None:
+            self.stats.count('runs')
+
+    def read(self, paths):
+        """
+        Read, fix up and spill every QSO in the input files
+        """
+        from adif_merge import columnar
+        with stage(self.stats, "read", exclude="spill"):
+            for path in paths:
+                filename = os.path.basename(path)
+                if columnar.is_columnar_file(path):
+                    for qso in columnar.read_columnar(path, self.compact):
+                        self.add(qso)
+                    continue
+                for qso in iter_adif_file(path):
+                    try:
+                        qso = fixup_qso(qso, filename, self.compact)
+                    except QSOError as err:
+                        reason, qso = err.args
+                        logging.warning("Ignoring QSO: %s", reason)
+                        self.malformed.append(qso)
+                        continue
+                    self.add(qso)
+            self.spill()
+        if self.stats is not None:
+            self.stats.count('files', len(paths))
+            self.stats.count('qsos', self.serial)
+            self.stats.count('malformed', len(self.malformed))
+
+    def partitions(self):
+        """
+        Group the slots into ranges that fit the budget.  A slot bigger
+        than that is a partition of its own, buckets can't be split.
+        """
+        limit = self.budget * PARTITION_SHARE
+        ranges = []
+        start = size = 0
+        for slot, slot_size in enumerate(self.slot_sizes):
+            if size and size + slot_size > limit:
+                ranges.append((start, slot))
+                start = slot
+                size = 0
+            size += slot_size
+        if size:
+            ranges.append((start, SPILL_SLOTS))
+        return ranges
+
+    def _load(self, start, end):
+        """
+        The (timestamp, serial, qso) records of a partition from every
+        run, in time order
+        """
+        sorted_slots = []
+        for path, offsets in self.runs:
+            with open(path, "rb") as rfd:
+                for slot in range(start, end):
+                    if slot in offsets:
+                        rfd.seek(offsets[slot])
+                        sorted_slots.append(pickle.load(rfd))
+        return heapq.merge(*sorted_slots, key=itemgetter(0, 1))
+
+    def _merge_partition(self, start, end, window):
+        """
+        Merge a partition like merge_qsos() does, returning its surviving
+        QSOs keyed by (timestamp, bucket's first timestamp and serial
+        number, position in bucket) for the k-way merge of all of them
+        """
+        buckets = {}
+        for timestamp, serial, qso in self._load(start, end):
+            key = bucket_key(qso)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = bucket = ((timestamp, serial), [])
+            bucket[1].append((timestamp, qso))
+        merged = []
+        for first, entries in buckets.values():
+            for position, (timestamp, qso) in enumerate(merge_bucket(entries, window)):
+                merged.append(((timestamp,) + first + (position,), qso))
+        merged.sort(key=itemgetter(0))
+        return len(buckets), merged
+
+    def merge(self, window):
+        """
+        Merge every partition into a sorted result file, returning the
+        ExternalResult that streams the merged log from them
+        """
+        results = []
+        count = 0
+        with stage(self.stats, "merge"):
+            partitions = self.partitions()
+            readers = min(len(partitions), MERGE_FAN_IN)
+            for start, end in partitions:
+                bucket_count, merged = self._merge_partition(start, end, window)
+                # the merged QSOs hold all of the partition's QSOs
+                size = sum(self.slot_sizes[start:end])
+                results.append(self._write_result(merged, size, len(merged), readers))
+                count += len(merged)
+                if self.stats is not None:
+                    self.stats.count('buckets', bucket_count)
+                    for _key, qso in merged:
+                        if '_UNMERGED' in qso:
+                            self.stats.count('problem_qsos')
+                            self.stats.count('runts', len(qso['_UNMERGED']))
+            # the runs aren't needed any more
+            for path, _offsets in self.runs:
+                os.remove(path)
+            self.runs = []
+            results = self._reduce(results)
+        if self.stats is not None:
+            self.stats.count('partitions', len(partitions))
+            self.stats.count('merges', self.serial - count)
+        logging.info("Merged %d QSOs in %d partitions into %d", self.serial, len(partitions), count)
+        return ExternalResult(self, results, count)
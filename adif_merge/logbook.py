@@ -0,0 +1,243 @@
+"""
+Merged logbook kept in an indexed SQLite database.
+
+Each merged QSO is a row holding the QSO as JSON, alongside indexed
+copies of its bucket (CALL/BAND/MODE/SUBMODE), QSO_DATE/TIME_ON as
+epoch seconds and its QSL received status.  The QSOs as read are kept
+as well, so that new QSOs can be merged like merge_qsos() would have
+merged them along with every QSO read before: the QSOs of their bucket
+chained to them by gaps shorter than the merge window are looked up
+through the index and merged again, and only the logbook entries in
+that span are replaced.  Exports are streamed from a query instead of
+loading the whole log, optionally limited by date, band or QSL status.
+"""
+import heapq
+import json
+import logging
+import os
+import sqlite3
+from operator import itemgetter
+
+from adif_merge import _date_timestamp, bucketize, merge_bucket
+from adif_merge.state import file_digest
+
+LOGBOOK_VERSION = 2
+
+# QSL received fields, a QSO is confirmed if any of them is Y(es) or V(erified)
+QSL_FIELDS = ['QSL_RCVD', 'LOTW_QSL_RCVD', 'EQSL_QSL_RCVD']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ingested (digest TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS malformed (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS qsos (
+    id INTEGER PRIMARY KEY,
+    call TEXT NOT NULL,
+    band TEXT NOT NULL,
+    mode TEXT,
+    submode TEXT,
+    time_on INTEGER NOT NULL,
+    qsl_rcvd TEXT,
+    lotw_qsl_rcvd TEXT,
+    eqsl_qsl_rcvd TEXT,
+    first_time INTEGER NOT NULL,
+    first_id INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS qsos_bucket ON qsos (call, band, mode, submode, time_on);
+CREATE INDEX IF NOT EXISTS qsos_time ON qsos (time_on, first_time, first_id);
+CREATE INDEX IF NOT EXISTS qsos_qsl ON qsos (qsl_rcvd, lotw_qsl_rcvd, eqsl_qsl_rcvd);
+CREATE TABLE IF NOT EXISTS raw (
+    id INTEGER PRIMARY KEY,
+    call TEXT NOT NULL,
+    band TEXT NOT NULL,
+    mode TEXT,
+    submode TEXT,
+    time_on INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS raw_bucket ON raw (call, band, mode, submode, time_on);
+"""
+
+_INSERT = ("INSERT INTO qsos (call, band, mode, submode, time_on, qsl_rcvd, lotw_qsl_rcvd, "
+           "eqsl_qsl_rcvd, first_time, first_id, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+_DELETE = ("DELETE FROM qsos WHERE call = ? AND band = ? AND mode IS ? AND submode IS ? "
+           "AND time_on >= ? AND time_on <= ?")
+_FIRST = ("UPDATE qsos SET first_time = ?, first_id = ? WHERE call = ? AND band = ? "
+          "AND mode IS ? AND submode IS ?")
+_RAW_INSERT = ("INSERT INTO raw (id, call, band, mode, submode, time_on, data) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)")
+# QSOs read before, on a tie in time in the order they were read
+_RAW = ("SELECT time_on, data FROM raw WHERE call = ? AND band = ? AND mode IS ? "
+        "AND submode IS ? AND time_on > ? AND time_on < ? ORDER BY time_on, id")
+_RAW_FIRST = ("SELECT time_on, id FROM raw WHERE call = ? AND band = ? AND mode IS ? "
+              "AND submode IS ? ORDER BY time_on, id LIMIT 1")
+
+
+def _dumps(qso):
+    return json.dumps(qso, separators=(",", ":"), default=dict)
+
+
+class LogbookQuery:
+    """
+    The QSOs of a logbook matching a filter, in time order, ties in
+    the order of their buckets' first QSO like merge_qsos().  Each
+    iteration runs the query again and streams the rows from SQLite.
+    """
+    def __init__(self, db, where, params):
+        self.db = db
+        self.where = where
+        self.params = params
+
+    def __iter__(self):
+        cursor = self.db.execute(
+            "SELECT data FROM qsos" + self.where + " ORDER BY time_on, first_time, first_id, id",
+            self.params)
+        for (data,) in cursor:
+            yield json.loads(data)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM qsos" + self.where, self.params).fetchone()[0]
+
+
+class Logbook:
+    """
+    Merged log persisted in SQLite, merged into by index lookups.
+    """
+    def __init__(self, path, window):
+        new = not os.path.exists(path)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.executescript(_SCHEMA)
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        if new or not meta:
+            logging.info("%s: starting new logbook", path)
+            self._set_meta(version=LOGBOOK_VERSION, window=window)
+        elif int(meta['version']) != LOGBOOK_VERSION:
+            raise ValueError("{}: unsupported logbook version {}".format(path, meta['version']))
+        elif int(meta['window']) != window:
+            logging.warning("%s: logbook was merged with a %s second window, "
+                            "existing entries are not re-merged", path, meta['window'])
+            self._set_meta(window=window)
+        self.window = window
+
+    def _set_meta(self, **values):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                [(key, str(value)) for key, value in values.items()])
+
+    def close(self):
+        self.db.close()
+
+    def new_inputs(self, paths):
+        """
+        Return (path, digest) for the input files not merged into the logbook yet.
+        """
+        inputs = []
+        seen = set()
+        for path in paths:
+            digest = file_digest(path)
+            row = self.db.execute("SELECT name FROM ingested WHERE digest = ?",
+                                  (digest,)).fetchone()
+            if row is not None or digest in seen:
+                logging.info("%s: already merged (as %s), skipping",
+                             path, row[0] if row else "this run")
+                continue
+            seen.add(digest)
+            inputs.append((path, digest))
+        return inputs
+
+    @staticmethod
+    def _row(timestamp, qso, first):
+        return [timestamp] + [qso.get(field) for field in QSL_FIELDS] + list(first) + [_dumps(qso)]
+
+    def _raw(self, key, start, end):
+        return [(time_on, json.loads(data))
+                for time_on, data in self.db.execute(_RAW, key + (start, end))]
+
+    def _span(self, key, entries):
+        """
+        The QSOs read before that are chained to the new entries of a
+        bucket by gaps shorter than the merge window, whose merge the new
+        ones may change, and the first and last timestamp of them all
+        """
+        start, end = entries[0][0], entries[-1][0]
+        raw = self._raw(key, start - self.window, end + self.window)
+        while raw and raw[0][0] < start:
+            start = raw[0][0]
+            raw = self._raw(key, start - self.window, start) + raw
+        while raw and raw[-1][0] > end:
+            end = raw[-1][0]
+            raw += self._raw(key, end, end + self.window)
+        return raw, start, end
+
+    def merge(self, qsos, malformed=(), inputs=()):
+        """
+        Merge newly read QSOs into the logbook in a single transaction.
+
+        The span of each bucket the new QSOs fall into is merged again
+        from the QSOs as read, giving the same entries as merging all
+        of them at once would.
+        """
+        raw_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM raw").fetchone()[0] + 1
+        raw_inserts = []
+        spans = []
+        firsts = []
+        inserts = []
+        for key, entries in bucketize(qsos).items():
+            # as read, before merging changes them
+            new_first = (entries[0][0], raw_id)
+            for timestamp, qso in entries:
+                raw_inserts.append([raw_id] + list(key) + [timestamp, _dumps(qso)])
+                raw_id += 1
+            first = self.db.execute(_RAW_FIRST, key).fetchone()
+            if first is None or new_first < tuple(first):
+                first = new_first
+                firsts.append(first + key)
+            raw, start, end = self._span(key, entries)
+            spans.append(key + (start, end))
+            # earlier runs' QSOs go first on a tie, as if read first
+            for timestamp, qso in merge_bucket(heapq.merge(raw, entries, key=itemgetter(0)),
+                                               self.window):
+                inserts.append(list(key) + self._row(timestamp, qso, first))
+        with self.db:
+            self.db.executemany(_RAW_INSERT, raw_inserts)
+            replaced = self.db.executemany(_DELETE, spans).rowcount
+            self.db.executemany(_FIRST, firsts)
+            self.db.executemany(_INSERT, inserts)
+            self.db.executemany("INSERT INTO malformed (data) VALUES (?)",
+                                [(json.dumps(qso),) for qso in malformed])
+            self.db.executemany("INSERT OR REPLACE INTO ingested (digest, name) VALUES (?, ?)",
+                                [(digest, os.path.basename(path)) for path, digest in inputs])
+        logging.info("Merged %d new QSOs, replacing %d logbook entries with %d",
+                     len(qsos), replaced, len(inserts))
+
+    def malformed(self):
+        """
+        Every QSO rejected upon load, over all runs
+        """
+        return [json.loads(data) for (data,) in
+                self.db.execute("SELECT data FROM malformed ORDER BY id")]
+
+    def qsos(self, since=None, until=None, band=None, unconfirmed=False):
+        """
+        QSOs from since to until (YYYYMMDD, inclusive) on band, or only
+        those not confirmed by any QSL, in time order
+        """
+        clauses = []
+        params = []
+        if since:
+            clauses.append("time_on >= ?")
+            params.append(_date_timestamp(since))
+        if until:
+            clauses.append("time_on < ?")
+            params.append(_date_timestamp(until) + 86400)
+        if band:
+            clauses.append("band = ?")
+            params.append(band.upper())
+        if unconfirmed:
+            clauses.extend("coalesce({}, '') NOT IN ('Y', 'V')".format(field.lower())
+                           for field in QSL_FIELDS)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return LogbookQuery(self.db, where, params)
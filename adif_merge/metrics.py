@@ -0,0 +1,186 @@
+"""
+Minimal in-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are kept in a Registry and rendered by
+Registry.expose() for a local collector to scrape, without needing any
+metrics client library or external service.
+"""
+import math
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a small upload to a very large merge
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    A metric family, with one value per combination of label values
+    """
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{}: expected labels {}, got {}".format(
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yield (suffix, label values, extra labels, value) for each sample
+        """
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            yield "", labels, (), value
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation.replace("\n", " ")),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix,
+                                            _format_labels(self.labelnames, labels, extra),
+                                            _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up
+    """
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("{}: counters can only increase".format(self.name))
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, either set directly or read from
+    function at scrape time
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        # function returns a value, or a {label values: value} mapping
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, sample in sorted(value.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield "", labels, (), sample
+
+
+class Histogram(Metric):
+    """
+    Observations counted into cumulative buckets, plus their count and sum
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                self.values[key] = entry = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, (list(entry[0]), entry[1], entry[2]))
+                      for labels, entry in self.values.items()]
+        for labels, (counts, count, total) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", labels, (("le", _format_value(float(bound))),), cumulative
+            yield "_count", labels, (), count
+            yield "_sum", labels, (), total
+
+
+class Registry:
+    """
+    The set of metrics exposed together
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        """
+        All metrics in the Prometheus text format
+        """
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
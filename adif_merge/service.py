@@ -1,29 +1,605 @@
 import os
 import argparse
+import hashlib
+import heapq
+import json
 import logging
 import uuid
 import time
 import shutil
-from flask import Flask, render_template, request, session
+import threading
+import io
+import multiprocessing
+import tarfile
+import tempfile
+import weakref
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, abort, jsonify, redirect, render_template, request, send_file, session, url_for
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
 from apscheduler.schedulers.background import BackgroundScheduler
-from adif_merge import setup_logging, process_adifs, parse_args
+import adif_merge
+from adif_merge import setup_logging
+from adif_merge import metrics
 
 
 UPLOAD_FOLDER = os.getenv("AMS_UPLOAD_FOLDER", default="adif_merge/static")
+# kept outside the upload folder, which is served as static files
+SESSION_INDEX = os.getenv("AMS_SESSION_INDEX", default=os.path.join(
+    os.path.dirname(os.path.abspath(UPLOAD_FOLDER)), "sessions.json"))
+SESSION_LIFETIME = 3600
 ALLOWED_EXTENSIONS = {"ADI", "adi", "ADIF", "adif"}
+BUNDLE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64 MB
 app.secret_key = os.getenv("AMS_SECRET_KEY", default=b"abcdefghijklmn")
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MERGE_WORKERS'] = int(os.getenv("AMS_MERGE_WORKERS", default=os.cpu_count() or 1))
+app.config['MERGE_QUEUE_LIMIT'] = int(os.getenv("AMS_MERGE_QUEUE_LIMIT", default=16))
+# limit on the unpacked size of the logs in zip/tar bundles
+app.config['MAX_BUNDLE_SIZE'] = int(os.getenv("AMS_MAX_BUNDLE_SIZE", default=256 * 1024 * 1024))
+# results larger than this are spilled to the session folder instead of kept in memory
+app.config['SPILL_SIZE'] = int(os.getenv("AMS_SPILL_SIZE", default=4 * 1024 * 1024))
+# total size of the results kept in memory, the oldest are spilled beyond that
+app.config['RESULT_MEMORY'] = int(os.getenv("AMS_RESULT_MEMORY", default=64 * 1024 * 1024))
+# results of identical merge requests are reused for this long, up to this many bytes
+app.config['RESULT_CACHE_TTL'] = int(os.getenv("AMS_RESULT_CACHE_TTL", default=3600))
+app.config['RESULT_CACHE_SIZE'] = int(os.getenv("AMS_RESULT_CACHE_SIZE", default=256 * 1024 * 1024))
+# total size of all session folders, oldest sessions are removed beyond that
+app.config['DISK_QUOTA'] = int(os.getenv("AMS_DISK_QUOTA", default=1024 * 1024 * 1024))
+
+registry = metrics.Registry()
+REQUESTS = registry.counter(
+    "adif_merge_http_requests_total", "HTTP requests by endpoint and status", ["endpoint", "status"])
+UPLOAD_BYTES = registry.counter(
+    "adif_merge_upload_bytes_total", "Bytes of uploaded logs and bundles")
+MERGE_JOBS = registry.counter(
+    "adif_merge_merge_jobs_total", "Merge jobs by outcome (done, failed, cached, rejected)", ["outcome"])
+MERGE_SECONDS = registry.histogram(
+    "adif_merge_merge_seconds", "Time from submitting a merge job to its result being ready")
+STAGE_SECONDS = registry.counter(
+    "adif_merge_stage_seconds_total", "Wall time spent in each merge stage", ["stage"])
+QSOS = registry.counter(
+    "adif_merge_qsos_total", "QSOs read, rejected as malformed and written by merges", ["kind"])
+CLEANUP_RUNS = registry.counter(
+    "adif_merge_cleanup_runs_total", "Cleanup runs")
+CLEANUP_SECONDS = registry.counter(
+    "adif_merge_cleanup_seconds_total", "Time spent cleaning up")
+CLEANUP_REMOVED = registry.counter(
+    "adif_merge_cleanup_sessions_removed_total", "Session folders removed, by reason", ["reason"])
+RESULT_CACHE = registry.counter(
+    "adif_merge_result_cache_requests_total", "Result cache lookups by outcome", ["outcome"])
+
+# merge jobs run in a pool of worker processes, jobs maps job id -> Job
+executor = None
+executor_lock = threading.Lock()
+jobs = dict()
+jobs_lock = threading.Lock()
+
+
+class ResultFile:
+    """
+    A merge output, held in memory or spilled to the session folder if
+    it's large, or once the results in memory exceed their budget
+    """
+    def __init__(self, data, path, sid):
+        self.size = len(data)
+        self.path = path
+        self.sid = sid
+        self.data = data
+        if self.size > app.config['SPILL_SIZE']:
+            self.spill()
+        if self.data is not None:
+            result_memory.add(self)
+
+    def spill(self):
+        """
+        Move the result to disk, keeping it in memory if that fails
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as wfd:
+                wfd.write(self.data)
+        except OSError as err:
+            logging.error("Result could not be spilled to {}: {}".format(self.path, err))
+            return
+        sessions.grow(self.sid, self.size)
+        self.data = None
+        logging.debug("Spilled {} bytes to {}".format(self.size, self.path))
+
+    def available(self):
+        # spilled results go away along with the session folder
+        return self.data is not None or os.path.exists(self.path)
+
+    def send(self, name):
+        # may be spilled by another request meanwhile
+        data = self.data
+        if data is None:
+            return send_file(self.path, as_attachment=True, download_name=name)
+        return send_file(io.BytesIO(data), as_attachment=True, download_name=name,
+                         mimetype="application/octet-stream")
+
+
+class ResultMemory:
+    """
+    Results held in memory, oldest first.  Once they take more than
+    max_bytes in total the oldest are spilled to their session folders.
+
+    Only weak references are kept, results dropped by their jobs and
+    the result cache are forgotten on the next add.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, result_file):
+        spill = list()
+        with self.lock:
+            for key, (ref, size) in list(self.results.items()):
+                held = ref()
+                if held is None or held.data is None:
+                    del self.results[key]
+                    self.size -= size
+            self.results[id(result_file)] = (weakref.ref(result_file), result_file.size)
+            self.size += result_file.size
+            while self.size > self.max_bytes and self.results:
+                _key, (ref, size) = self.results.popitem(last=False)
+                self.size -= size
+                held = ref()
+                if held is not None:
+                    spill.append(held)
+        for held in spill:
+            held.spill()
+
+
+result_memory = ResultMemory(app.config['RESULT_MEMORY'])
+
+
+class SessionRegistry:
+    """
+    Session folders ordered by expiry, so cleanup only has to look at
+    the sessions that are due instead of scanning the upload folder.
+
+    sessions maps sid -> [expiry time, bytes on disk], the heap holds
+    (expiry time, sid) and may contain stale entries for sessions that
+    have since been touched again, these are skipped when popped.  The
+    registry is saved to a small JSON index so it survives restarts.
+    """
+    def __init__(self, folder, index_path, lifetime, quota):
+        self.folder = folder
+        self.index_path = index_path
+        self.lifetime = lifetime
+        self.quota = quota
+        self.sessions = dict()
+        self.heap = list()
+        self.size = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the index, and adopt any session folders missing from it
+        """
+        try:
+            with open(self.index_path, "r") as rfd:
+                sessions = json.load(rfd)
+        except FileNotFoundError:
+            sessions = dict()
+        except (OSError, ValueError) as err:
+            logging.warning("{}: discarding unreadable session index: {}".format(self.index_path, err))
+            sessions = dict()
+        with self.lock:
+            self.sessions = dict()
+            self.heap = list()
+            self.size = 0
+            for sid in os.listdir(self.folder):
+                path = os.path.join(self.folder, sid)
+                if not os.path.isdir(path):
+                    continue
+                entry = sessions.get(sid)
+                if entry is None:
+                    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                    entry = [os.stat(path).st_mtime + self.lifetime, size]
+                self._add(sid, *entry)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            sessions = dict(self.sessions)
+            self.dirty = False
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as wfd:
+            json.dump(sessions, wfd)
+        os.replace(tmp_path, self.index_path)
+
+    def _add(self, sid, expires, size):
+        self.sessions[sid] = [expires, size]
+        self.size += size
+        heapq.heappush(self.heap, (expires, sid))
+
+    def touch(self, sid, size=0):
+        """
+        Extend a session's lifetime, adding size bytes written to its folder
+        """
+        with self.lock:
+            entry = self.sessions.pop(sid, None)
+            if entry is not None:
+                self.size -= entry[1]
+                size += entry[1]
+            self._add(sid, time.time() + self.lifetime, size)
+            self.dirty = True
+
+    def grow(self, sid, size):
+        """
+        Add size bytes written to a session's folder, keeping its expiry
+        """
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                self._add(sid, time.time() + self.lifetime, size)
+            else:
+                entry[1] += size
+                self.size += size
+            self.dirty = True
+
+    def expire(self):
+        """
+        Remove expired sessions, then the oldest ones beyond the disk quota
+        """
+        now = time.time()
+        expired = list()
+        with self.lock:
+            while self.heap:
+                expires, sid = self.heap[0]
+                entry = self.sessions.get(sid)
+                if entry is None or entry[0] != expires:
+                    heapq.heappop(self.heap)
+                    continue
+                if expires > now and self.size <= self.quota:
+                    break
+                heapq.heappop(self.heap)
+                del self.sessions[sid]
+                self.size -= entry[1]
+                self.dirty = True
+                expired.append((sid, expires > now))
+        for sid, over_quota in expired:
+            path = os.path.join(self.folder, sid)
+            logging.info("Cleanup: Removing {}{}".format(path, " (over disk quota)" if over_quota else ""))
+            shutil.rmtree(path, ignore_errors=True)
+        return expired
+
+
+sessions = SessionRegistry(UPLOAD_FOLDER, SESSION_INDEX, SESSION_LIFETIME, app.config['DISK_QUOTA'])
+
+
+class ResultCache:
+    """
+    Result files of recent merges, keyed on the uploads' content and
+    the merge options.  Entries expire after ttl seconds and the least
+    recently used ones are evicted once the total size exceeds max_bytes.
+    """
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(digests, options):
+        key = hashlib.sha256()
+        for name, digest in digests:
+            key.update("{}\0{}\0".format(name, digest).encode("utf-8"))
+        key.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+        return key.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            created, size, files = entry
+            if time.time() - created > self.ttl or \
+                    not all(f.available() for f in files.values()):
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return files
+
+    def put(self, key, files):
+        size = sum(f.size for f in files.values())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time(), size, files)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def expire(self):
+        with self.lock:
+            for key, (created, _size, _files) in list(self.entries.items()):
+                if time.time() - created > self.ttl:
+                    self._remove(key)
+
+    def _remove(self, key):
+        _created, size, _files = self.entries.pop(key)
+        self.size -= size
+
+
+result_cache = ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+
+
+class Job:
+    def __init__(self, job_id, sid, session_path, future, cache_key=None, files=None, pool=None):
+        self.job_id = job_id
+        self.sid = sid
+        self.session_path = session_path
+        self.future = future
+        self.cache_key = cache_key
+        # the worker pool running the job, replaced if a worker dies
+        self.pool = pool
+        self.submitted = time.time()
+        if future is None:
+            # answered from the result cache
+            self.state = "done"
+            self.files = files
+        else:
+            self.state = "queued"
+            self.files = dict()
+            future.add_done_callback(self.finished)
+
+    def finished(self, future):
+        # runs in the executor's thread, where exceptions would be lost;
+        # drop the future so only the (possibly spilled) result files are
+        # kept around, and the job never stays queued
+        try:
+            error = future.exception()
+            MERGE_SECONDS.observe(time.time() - self.submitted)
+            if error:
+                if isinstance(error, BrokenProcessPool):
+                    discard_executor(self.pool)
+                raise error
+            self.store(future.result())
+            MERGE_JOBS.inc(outcome="done")
+            self.state = "done"
+        except Exception as error:
+            logging.error("Merge job failed: {}".format(error))
+            MERGE_JOBS.inc(outcome="failed")
+            self.files = dict()
+            self.state = "failed"
+        finally:
+            self.future = None
+            self.pool = None
+
+    def store(self, result):
+        if result.stats:
+            for name, stage in result.stats['stages'].items():
+                STAGE_SECONDS.inc(stage['wall'], stage=name)
+            for kind in ('qsos', 'malformed', 'written'):
+                QSOS.inc(result.stats['counters'].get(kind, 0), kind=kind)
+        outputs = [("merged.adi", result.adif),
+                   ("problems.json", result.problems),
+                   ("wsjtx.log", result.wsjtx_log)]
+        # the session folder may have expired while the job was queued
+        os.makedirs(self.session_path, exist_ok=True)
+        sessions.touch(self.sid)
+        for name, data in outputs:
+            if data is not None:
+                # a session may run several jobs, each spills to files of its own
+                path = os.path.join(self.session_path, "{}-{}".format(self.job_id, name))
+                self.files[name] = ResultFile(data, path, self.sid)
+        logging.debug("Done! {} QSOs merged".format(result.qso_count))
+        if self.cache_key:
+            result_cache.put(self.cache_key, self.files)
+
+    def status(self):
+        future = self.future
+        if self.state == "queued" and future is not None and future.running():
+            return "running"
+        return self.state
+
+    def done(self):
+        return self.state in ("done", "failed")
+
+
+def worker_init(level):
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=level)
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            # spawn, as forking a process with scheduler threads is unsafe
+            executor = ProcessPoolExecutor(
+                max_workers=app.config['MERGE_WORKERS'],
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=worker_init, initargs=(logging.getLogger().level,))
+        return executor
+
+
+def discard_executor(pool):
+    """
+    Drop a worker pool broken by a worker dying (e.g. killed when out of
+    memory), so that get_executor() starts a new one.  The jobs it still
+    had fail with BrokenProcessPool.
+    """
+    global executor
+    with executor_lock:
+        if executor is not pool:
+            return
+        executor = None
+    logging.error("Merge worker died, replacing the worker pool")
+    pool.shutdown(wait=False)
+
+
+def submit_merge(inputs, options):
+    """
+    Submit a merge to the worker pool, replacing the pool if it's broken.
+    Returns the pool and the future of the merge.
+    """
+    pool = get_executor()
+    try:
+        return pool, pool.submit(adif_merge.merge, inputs, options)
+    except BrokenProcessPool:
+        discard_executor(pool)
+    pool = get_executor()
+    return pool, pool.submit(adif_merge.merge, inputs, options)
+
+
+def queue_depth():
+    """
+    Number of merge jobs submitted but not yet finished
+    """
+    with jobs_lock:
+        return sum(1 for job in jobs.values() if not job.done())
 
 
 def allowed_file(filename):
     return '.' in filename and \
             filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS       
 
+def allowed_bundle(filename):
+    return filename.lower().endswith(BUNDLE_EXTENSIONS)
+
+
+def bundle_logs(filename, stream):
+    """
+    Yield (name, binary stream) for each ADIF log in a zip or tar bundle
+    """
+    total = 0
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(stream) as bundle:
+            for info in bundle.infolist():
+                if info.is_dir() or not allowed_file(info.filename):
+                    continue
+                total += info.file_size
+                if total > app.config['MAX_BUNDLE_SIZE']:
+                    raise RequestEntityTooLarge()
+                with bundle.open(info) as member:
+                    yield os.path.basename(info.filename), member
+    else:
+        with tarfile.open(fileobj=stream, mode="r:*") as bundle:
+            for member in bundle:
+                if not member.isfile() or not allowed_file(member.name):
+                    continue
+                total += member.size
+                if total > app.config['MAX_BUNDLE_SIZE']:
+                    raise RequestEntityTooLarge()
+                yield os.path.basename(member.name), bundle.extractfile(member)
+
+
+class UploadParser:
+    """
+    Parse a multipart/form-data upload as it streams in.
+
+    ADIF logs are fed through an ADIFReader chunk by chunk, so they are
+    tokenized while the rest of the upload is still arriving.  Bundles
+    have to be complete before they can be unpacked, so they are spooled
+    and read once their last chunk is in.  Afterwards inputs holds a
+    (name, raw QSOs) pair per log, digests an (uploaded file name,
+    SHA-256) pair per uploaded file and form the other form fields.
+    """
+    def __init__(self):
+        self.inputs = list()
+        self.digests = list()
+        self.form = dict()
+        self._digest = None
+        self._part = None
+        self._field = None
+        self._reader = None
+        self._bundle = None
+
+    def _name(self, filename):
+        return "{:02d}__{}".format(len(self.inputs), secure_filename(filename))
+
+    def _start_file(self, part):
+        if not part.filename:
+            self._part = None
+            return
+        self._digest = (part.filename, hashlib.sha256())
+        if allowed_file(part.filename):
+            self._reader = adif_merge.ADIFReader(part.filename)
+            self._part = (self._name(part.filename), [])
+        elif allowed_bundle(part.filename):
+            self._bundle = (part.filename, tempfile.SpooledTemporaryFile(
+                max_size=app.config['SPILL_SIZE']))
+        else:
+            raise BadRequest("unsupported file type: {}".format(part.filename))
+
+    def _data(self, data, more_data):
+        if self._field is not None:
+            name, values = self._field
+            values.append(data)
+            if sum(map(len, values)) > (request.max_form_memory_size or float("inf")):
+                raise RequestEntityTooLarge()
+            if not more_data:
+                self.form[name] = b"".join(values).decode("utf-8", "replace")
+                self._field = None
+            return
+        if self._digest is not None:
+            filename, digest = self._digest
+            digest.update(data)
+            UPLOAD_BYTES.inc(len(data))
+            if not more_data:
+                self.digests.append((filename, digest.hexdigest()))
+                self._digest = None
+        if self._bundle is not None:
+            filename, spool = self._bundle
+            spool.write(data)
+            if not more_data:
+                spool.seek(0)
+                for name, stream in bundle_logs(filename, spool):
+                    self.inputs.append((self._name(name), list(adif_merge.iter_adif_stream(
+                        stream, adif_merge.ADIFReader(name)))))
+                    logging.debug("Unpacked: {} from {}".format(name, filename))
+                spool.close()
+                self._bundle = None
+        elif self._part is not None:
+            name, qsos = self._part
+            qsos.extend(self._reader.feed(data))
+            if not more_data:
+                qsos.extend(self._reader.close())
+                self.inputs.append(self._part)
+                self._part = None
+                self._reader = None
+                logging.debug("Uploaded: {}".format(name))
+
+    def parse(self, stream, boundary):
+        decoder = MultipartDecoder(boundary, max_form_memory_size=request.max_form_memory_size,
+                                   max_parts=request.max_form_parts)
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    self._field = (event.name, [])
+                elif isinstance(event, File):
+                    self._start_file(event)
+                elif isinstance(event, Data):
+                    self._data(event.data, event.more_data)
+                event = decoder.next_event()
+            if not chunk or isinstance(event, Epilogue):
+                break
+        return self
+
+
 @app.route("/")
 def form():
     session["sid"] = uuid.uuid4().hex
@@ -32,84 +608,181 @@ def form():
 
 @app.route("/merge", methods=["POST"])
 def merge():
-    if 'file1' not in request.files or 'file2' not in request.files:
+    content_type, params = parse_options_header(request.content_type or "")
+    if content_type != "multipart/form-data" or "boundary" not in params:
         return "bad input", 400
 
     # lets have one folder per session:
     session_path = os.path.join(app.config['UPLOAD_FOLDER'], session["sid"])
-    if not os.path.exists(session_path):
-        try:
-            os.mkdir(session_path)
-        except OSError:
-            logging.error ("Session folder could not be created: {}".format(session_path))
-
-    # upload and store inputs
-    file_paths = list()
-    for i, f in enumerate(["file1", "file2"]):
-        file = request.files[f]
-        if file.filename == "":
-            return "bad input, no files selected", 400
-        if file and allowed_file(file.filename):
-            filename = "{:02d}__{}".format(i, secure_filename(file.filename))
-            fp = os.path.join(session_path, filename)
-            try:
-                file.save(fp)
-                file_paths.append(fp)
-                logging.debug ("Uploaded: {}".format(fp))
-            except OSError:
-                logging.error ("Could not write: {}".format(fp))
-                return "Could not store: {}".format(filename), 501
+    try:
+        os.makedirs(session_path, exist_ok=True)
+    except OSError as err:
+        logging.error("Session folder could not be created: {}: {}".format(session_path, err))
+        return "server error, please try again later", 503
+    sessions.touch(session["sid"])
+
+    # parse inputs while they are uploaded, they are handed to the merge as is
+    start = time.perf_counter()
+    try:
+        upload = UploadParser().parse(request.stream, params["boundary"].encode("ascii"))
+    except (ValueError, tarfile.TarError, zipfile.BadZipFile) as err:
+        logging.info("Bad upload: {}".format(err))
+        return "bad input: {}".format(err), 400
+    # logs are parsed here, as they arrive, rather than in the merge workers
+    STAGE_SECONDS.inc(time.perf_counter() - start, stage="upload")
+    if not upload.inputs:
+        return "bad input, no files selected", 400
+    inputs = upload.inputs
 
     # check options
     try:
-        opt_time_window = int(request.form.get("time_window", 115))
-        opt_wsjtx_log = bool(request.form.get("option_wsjtx_log", False))
-        opt_problems = bool(request.form.get("option_problems", False))
-        opt_minimal = bool(request.form.get("option_minimal", False))
+        options = dict(
+            merge_window = int(upload.form.get("time_window", 115)),
+            wsjtx_log = bool(upload.form.get("option_wsjtx_log", False)),
+            problems = bool(upload.form.get("option_problems", False)),
+            minimal = bool(upload.form.get("option_minimal", False)),
+            )
+        cache_options = dict(options)
+        options['stats'] = True
     except:
         return "bad inputs", 400
 
-    # gen. args & call merge
-    arg_list = list()
-    if opt_minimal:
-        arg_list.append("--minimal")
-    if opt_problems:
-        arg_list.append("--problems")
-        arg_list.append("{}".format(os.path.join(session_path, "problems.json")))
-    if opt_wsjtx_log:
-        arg_list.append("--wsjtx-log")
-        arg_list.append("{}".format(os.path.join(session_path, "wsjtx.log")))
-    arg_list.append("--merge-window")
-    arg_list.append("{}".format(opt_time_window))
-    arg_list.append("--output")
-    arg_list.append("{}".format(os.path.join(session_path, "merged.adi")))
-    arg_list.extend(file_paths)
-    logging.debug("Arg list: {}".format(arg_list))
-    args = parse_args(arg_list)
-
-    # to the work ...
-    logging.debug("Triggering adif_merge with: {}".format(vars(args)))
-    process_adifs(args)
-    logging.debug("Done! Output: {}".format(args.output))
+    # identical uploads with identical options give identical results
+    cache_key = ResultCache.key(upload.digests, cache_options)
+    files = result_cache.get(cache_key)
+    RESULT_CACHE.inc(outcome="miss" if files is None else "hit")
+    if files is not None:
+        MERGE_JOBS.inc(outcome="cached")
+        job_id = uuid.uuid4().hex
+        with jobs_lock:
+            jobs[job_id] = Job(job_id, session["sid"], session_path, None, files=files)
+        logging.info("Merge job {} answered from result cache".format(job_id))
+        return redirect(url_for("result", job=job_id))
+
+    # hand the work to the worker pool, unless it's already backed up
+    with jobs_lock:
+        depth = sum(1 for job in jobs.values() if not job.done())
+        if depth >= app.config['MERGE_QUEUE_LIMIT']:
+            logging.warning("Merge queue full: {} jobs pending".format(depth))
+            MERGE_JOBS.inc(outcome="rejected")
+            return "too many merges in progress, please try again later", 429, {"Retry-After": "30"}
+        job_id = uuid.uuid4().hex
+        logging.debug("Triggering adif_merge with: {}".format(options))
+        pool, future = submit_merge(inputs, options)
+        jobs[job_id] = Job(job_id, session["sid"], session_path, future, cache_key, pool=pool)
+    logging.info("Queued merge job {} (queue depth {})".format(job_id, depth + 1))
+    return redirect(url_for("result", job=job_id))
+
+
+def get_job():
+    job = jobs.get(request.args.get("job", ""))
+    if job is None or job.sid != session.get("sid"):
+        return None
+    return job
+
+
+@app.route("/status")
+def status():
+    job = get_job()
+    if job is None:
+        return jsonify(status="unknown"), 404
+    return jsonify(status=job.status(), queue_depth=queue_depth())
+
+
+@app.route("/result")
+def result():
+    job = get_job()
+    if job is None:
+        return "unknown job", 404
+    if not job.done():
+        return render_template(
+            "pending.html",
+            title=os.getenv("AMS_TITLE", default="ADIF Merge Service"),
+            status = job.status(),
+            queue_depth = queue_depth(),
+            )
+    if job.state == "failed":
+        return "merge failed", 500
 
     # generate result
     return render_template(
         "result.html",
         title=os.getenv("AMS_TITLE", default="ADIF Merge Service"),
-        sid = session["sid"],
-        output_file_name = os.path.basename(args.output),
-        problems_file_name = os.path.basename(args.problems) if args.problems and os.path.exists(args.problems) else "",
-        wsjtx_log_file_name = os.path.basename(args.wsjtx_log) if args.wsjtx_log else "",
+        sid = job.sid,
+        job_id = request.args.get("job"),
+        output_file_name = "merged.adi",
+        problems_file_name = "problems.json" if "problems.json" in job.files else "",
+        wsjtx_log_file_name = "wsjtx.log" if "wsjtx.log" in job.files else "",
         )
 
 
+@app.route("/download")
+def download():
+    job = get_job()
+    name = request.args.get("file", "")
+    if job is None or name not in job.files:
+        abort(404)
+    return job.files[name].send(name)
+
+
+@app.route("/queue")
+def queue():
+    return jsonify(
+        queue_depth=queue_depth(),
+        queue_limit=app.config['MERGE_QUEUE_LIMIT'],
+        workers=app.config['MERGE_WORKERS'])
+
+
+def active_jobs():
+    states = {"queued": 0, "running": 0}
+    with jobs_lock:
+        for job in jobs.values():
+            status = job.status()
+            if status in states:
+                states[status] += 1
+    return states
+
+
+registry.gauge("adif_merge_active_jobs", "Merge jobs queued or running", ["state"], active_jobs)
+registry.gauge("adif_merge_queue_limit", "Merge jobs pending before new ones are rejected",
+               function=lambda: app.config['MERGE_QUEUE_LIMIT'])
+registry.gauge("adif_merge_sessions", "Session folders",
+               function=lambda: len(sessions.sessions))
+registry.gauge("adif_merge_session_disk_bytes", "Bytes of results spilled to session folders",
+               function=lambda: sessions.size)
+registry.gauge("adif_merge_session_disk_quota_bytes", "Disk quota for session folders",
+               function=lambda: sessions.quota)
+registry.gauge("adif_merge_result_memory_bytes", "Bytes of merge results held in memory",
+               function=lambda: result_memory.size)
+registry.gauge("adif_merge_result_cache_bytes", "Size of the cached merge results",
+               function=lambda: result_cache.size)
+registry.gauge("adif_merge_result_cache_entries", "Number of cached merge results",
+               function=lambda: len(result_cache.entries))
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(registry.expose(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.after_request
+def count_request(response):
+    REQUESTS.inc(endpoint=request.endpoint or "none", status=response.status_code)
+    return response
+
+
 def cleanup():
-    for f in os.listdir(UPLOAD_FOLDER):
-        path = os.path.join(UPLOAD_FOLDER, f)
-        if os.path.isdir(path):
-            if (time.time() - os.stat(path).st_mtime) > 3600:
-                logging.info("Cleanup: Removing {}".format(path))
-                shutil.rmtree(path)
+    start = time.perf_counter()
+    for _sid, over_quota in sessions.expire():
+        CLEANUP_REMOVED.inc(reason="quota" if over_quota else "expired")
+    sessions.save()
+    with jobs_lock:
+        for job_id, job in list(jobs.items()):
+            if job.done() and (time.time() - job.submitted) > SESSION_LIFETIME:
+                del jobs[job_id]
+    result_cache.expire()
+    CLEANUP_RUNS.inc()
+    CLEANUP_SECONDS.inc(time.perf_counter() - start)
 
 
 def main():
@@ -124,7 +797,28 @@ def main():
                         help="Log level for debugging")
     parser.add_argument('--debug', action="store_true",
                         help="Run server in dubgging mode")
+    parser.add_argument('--workers', type=int, default=app.config['MERGE_WORKERS'],
+                        help="Number of merge worker processes")
+    parser.add_argument('--queue-limit', type=int, default=app.config['MERGE_QUEUE_LIMIT'],
+                        help="Max. merge jobs pending before rejecting new ones")
+    parser.add_argument('--result-cache-size', type=int,
+                        default=app.config['RESULT_CACHE_SIZE'] // (1024 * 1024),
+                        help="Size of the merge result cache in MB (0 to disable)")
+    parser.add_argument('--result-cache-ttl', type=int, default=app.config['RESULT_CACHE_TTL'],
+                        help="Seconds merge results are reused for identical requests")
+    parser.add_argument('--disk-quota', type=int,
+                        default=app.config['DISK_QUOTA'] // (1024 * 1024),
+                        help="Max. MB used by session folders, oldest are removed first")
+    parser.add_argument('--result-memory', type=int,
+                        default=app.config['RESULT_MEMORY'] // (1024 * 1024),
+                        help="Max. MB of merge results kept in memory, oldest are spilled first")
     args = parser.parse_args()
+    app.config['MERGE_WORKERS'] = args.workers
+    app.config['MERGE_QUEUE_LIMIT'] = args.queue_limit
+    result_cache.max_bytes = args.result_cache_size * 1024 * 1024
+    result_cache.ttl = args.result_cache_ttl
+    sessions.quota = args.disk_quota * 1024 * 1024
+    result_memory.max_bytes = args.result_memory * 1024 * 1024
 
     setup_logging(args)
     logging.info("adif_merge.py server starting ...")
@@ -133,9 +827,10 @@ def main():
             os.mkdir(UPLOAD_FOLDER)
         except OSError:
             logging.error ("Upload folder could not be created: {}".format(UPLOAD_FOLDER))
-    # TODO: create cleanup job
+    sessions.load()
+    # only expired sessions are touched, so this is cheap to run often
     scheduler = BackgroundScheduler()
-    scheduler.add_job(cleanup, 'interval', minutes=120)
+    scheduler.add_job(cleanup, 'interval', minutes=1)
     scheduler.start()
     # start the server
     app.run(host=args.addr, port=args.port, debug=args.debug)
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""
+Incremental merging against a persisted merged-log state.
+
+The state keeps, for every bucket (CALL/BAND/MODE/SUBMODE), the time
+sorted merged entries along with the raw pre-merge QSOs they came from.
+New QSOs only cause their own buckets to be re-merged from raw, which
+gives exactly the result a full merge would, and input files already
+ingested are recognized by content hash and skipped.
+"""
+import hashlib
+import heapq
+import logging
+import os
+import pickle
+from operator import itemgetter
+
+from adif_merge import bucketize, merge_bucket
+
+STATE_VERSION = 1
+
+
+def file_digest(path):
+    """
+    SHA-256 of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as rfd:
+        for chunk in iter(lambda: rfd.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MergeState:
+    """
+    Merged log plus per-bucket index, persisted between runs.
+
+    Each bucket is [first QSO, pickled raw entries, merged entries], the
+    raw entries are only unpickled when new QSOs land in the bucket.  The
+    first QSO is kept as (timestamp, serial number of all QSOs ever read)
+    so buckets can be output in the same order as a full merge would.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.buckets = {}
+        self.ingested = {}
+        self.malformed = []
+        self.serial = 0
+
+    @classmethod
+    def load(cls, path, window):
+        """
+        Load a previously saved state, or start a new one if there is none.
+        """
+        if not os.path.exists(path):
+            logging.info("%s: starting new merge state", path)
+            return cls(window)
+        with open(path, "rb") as rfd:
+            saved = pickle.load(rfd)
+        if saved.get('version') != STATE_VERSION:
+            raise ValueError("{}: unsupported merge state version {}".format(
+                path, saved.get('version')))
+        state = cls(saved['window'])
+        state.buckets = saved['buckets']
+        state.ingested = saved['ingested']
+        state.malformed = saved['malformed']
+        state.serial = saved['serial']
+        if window != state.window:
+            logging.info("%s: merge window changed from %d to %d, re-merging everything",
+                         path, state.window, window)
+            state.remerge(window)
+        return state
+
+    def save(self, path):
+        """
+        Atomically replace the state file.
+        """
+        saved = {
+            'version': STATE_VERSION,
+            'window': self.window,
+            'buckets': self.buckets,
+            'ingested': self.ingested,
+            'malformed': self.malformed,
+            'serial': self.serial,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as wfd:
+            pickle.dump(saved, wfd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def new_inputs(self, paths):
+        """
+        Return (path, digest) for the input files we have not ingested yet.
+        """
+        inputs = []
+        seen = set()
+        for path in paths:
+            digest = file_digest(path)
+            if digest in self.ingested or digest in seen:
+                logging.info("%s: already merged (as %s), skipping",
+                             path, self.ingested.get(digest, "this run"))
+                continue
+            seen.add(digest)
+            inputs.append((path, digest))
+        return inputs
+
+    def remerge(self, window):
+        """
+        Re-merge every bucket from its raw QSOs using a new window.
+        """
+        self.window = window
+        for bucket in self.buckets.values():
+            raw = pickle.loads(bucket[1])
+            bucket[2] = merge_bucket(raw, window)
+
+    def merge(self, qsos, malformed, inputs=()):
+        """
+        Merge newly read QSOs into the buckets they belong to, and
+        remember the inputs they came from.
+        """
+        serials = {id(qso): self.serial + index for index, qso in enumerate(qsos)}
+        new = bucketize(qsos)
+        for key, entries in new.items():
+            first = (entries[0][0], serials[id(entries[0][1])])
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                first = min(bucket[0], first)
+                # earlier runs' QSOs go first on a tie, as if read first
+                entries = list(heapq.merge(pickle.loads(bucket[1]), entries, key=itemgetter(0)))
+            raw = pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+            self.buckets[key] = [first, raw, merge_bucket(entries, self.window)]
+        self.serial += len(qsos)
+        self.malformed.extend(malformed)
+        for path, digest in inputs:
+            self.ingested[digest] = os.path.basename(path)
+        logging.info("Merged %d new QSOs into %d of %d buckets",
+                     len(qsos), len(new), len(self.buckets))
+
+    def qsos(self):
+        """
+        All merged QSOs in time order
+        """
+        buckets = sorted(self.buckets.values(), key=itemgetter(0))
+        return [qso for _timestamp, qso in
+                heapq.merge(*[bucket[2] for bucket in buckets], key=itemgetter(0))]
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+"""
+Micro-benchmark for fixup_qso: QSOs/second over a synthetic log, for
+the table-driven fixup_qso and the field list walking one it replaced.
+
+    python3 benchmarks/fixup_qso.py [--count 1000000]
+"""
+import argparse
+import math
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adif_merge  # noqa: E402
+from adif_merge.benchmark import iter_synthetic_qsos  # noqa: E402
+
+# the records of this many contacts are recycled so the benchmark
+# measures fixup_qso rather than the cost of generating a million QSOs
+TEMPLATE_CONTACTS = 5000
+
+
+def baseline_fixup_qso(qso, path=""):
+    """
+    fixup_qso as it was before FIELD_FIXUPS, kept as the baseline
+    """
+    if path:
+        qso['_SOURCE_FILE'] = path
+    # if we're missing a madatory field, mark the QSO and do not process any of it
+    missing_mandatory = {field for field in adif_merge.FIELD_MANDATORY if field not in qso}
+    if missing_mandatory:
+        qso['_MISSING_FIELDS'] = list(missing_mandatory)
+        raise adif_merge.QSOError("{}: {} missing {}".format(
+            path,
+            "/".join([qso.get(field, field.lower()) for field in adif_merge.FIELD_MANDATORY]),
+            ", ".join(missing_mandatory)), qso)
+    for field in qso.keys():
+        if isinstance(qso[field], str):
+            qso[field] = qso[field].strip()
+    qso = {key: value for key, value in qso.items() if value}
+    qso = adif_merge.fixup_qso_mode(qso)
+    # TX_PWR should only be digits
+    for field in ['TX_PWR', 'RX_PWR']:
+        if field in qso:
+            if qso[field] == "NaN":
+                del qso[field]
+            else:
+                match = re.search(r'([\d\.]+)[Ww]', qso[field])
+                if match:
+                    qso[field] = match.group(1)
+                qso[field] = float(qso[field])
+                if qso[field] > 10000:
+                    qso[field] //= 10000
+    # if the field is a "PositiveInteger" or "Integer" field, make it an int
+    for field in adif_merge.FIELD_INTEGERS + adif_merge.FIELD_INTEGERS_POS:
+        if field in qso:
+            qso[field] = int(float(qso[field]))
+    # if the field is a "Number" make it a float, unless it's whole in which case int
+    for field in adif_merge.FIELD_NUMBERS:
+        if field in qso:
+            qso[field] = float(qso[field])
+            if field in ['FREQ', 'FREQ_TX']:
+                # round to 3 digits
+                qso[field] = round(qso[field], 3)
+            else:
+                # leave as an int if possible, otherwise float
+                (part, whole) = math.modf(float(qso[field]))
+                if not part:
+                    qso[field] = int(whole)
+    # band should always be uppercase
+    for field in ['BAND', 'BAND_RX']:
+        if field in qso:
+            qso[field] = qso[field].upper()
+    # some log sources replace / with _, restore /
+    for field in ['CALL', 'MYCALL']:
+        if field in qso:
+            qso[field] = qso[field].replace("_", "/").upper()
+    # properly "caseify" gridsquares... it's unnecessary but pleasant
+    for field in ['GRIDSQUARE', 'MY_GRIDSQUARE']:
+        if field in qso:
+            qso[field] = "{}{}".format(
+                qso[field][0:4].upper(), qso[field][4:].lower())
+    # remove bad LAT/LON entries
+    for field in ['LAT', 'LON']:
+        if field in qso and qso[field][1:] == "000 00.000":
+            del qso[field]
+    # remove bogus zero fields (DXCC zero is valid)
+    for field in ['A_INDEX', 'K_INDEX', 'SFI', 'DISTANCE', 'TX_PWR', 'RX_PWR'] + \
+            adif_merge.FIELD_ZONES:
+        if field in qso and not qso[field]:
+            del qso[field]
+    # look for a redundant comment field that matches our RST_SENT and RST_RCVD
+    for field in ['COMMENT', 'NOTES']:
+        if field in qso and 'RST_SENT' in qso and 'RST_RCVD' in qso:
+            match = re.search(r'Sent:?\s*([+-]?\d+)\s+Rcvd:?\s*([+-]?\d+)',
+                              qso[field], re.IGNORECASE)
+            if match and match.group(1) == qso['RST_SENT'] and match.group(2) == qso['RST_RCVD']:
+                del qso[field]
+    if qso.get('IOTA', "").replace("-", "").lower().strip() == "none":
+        del qso['IOTA']
+    return qso
+
+
+def qsos_per_second(fixup, templates, count):
+    """
+    Time fixup over count copies of the templates, less the copying
+    """
+    start = time.perf_counter()
+    for i in range(count):
+        filename, qso = templates[i % len(templates)]
+        dict(qso)
+    overhead = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        filename, qso = templates[i % len(templates)]
+        fixup(dict(qso), filename)
+    elapsed = time.perf_counter() - start - overhead
+    return elapsed, count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="fixup_qso micro-benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000000,
+                        help="Number of QSOs to process")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Random seed for the synthetic log")
+    args = parser.parse_args()
+
+    templates = list(iter_synthetic_qsos(TEMPLATE_CONTACTS, args.seed))
+    rates = []
+    for name, fixup in [("baseline", baseline_fixup_qso), ("fixup_qso", adif_merge.fixup_qso)]:
+        elapsed, rate = qsos_per_second(fixup, templates, args.count)
+        rates.append(rate)
+        print("{:10s} {} QSOs in {:.2f}s, {:,.0f} QSOs/second".format(
+            name + ":", args.count, elapsed, rate))
+    print("speedup:   {:.2f}x".format(rates[1] / rates[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+"""
+Memory benchmark: peak RSS of fixing up and merging the synthetic logs
+of adif_merge_bench (about 1M QSOs by default) with plain dict QSOs
+versus compact QSORecords.
+
+    python3 benchmarks/memory.py [--count 420000]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adif_merge  # noqa: E402
+from adif_merge import peak_rss_mb  # noqa: E402
+from adif_merge.benchmark import iter_synthetic_qsos  # noqa: E402
+
+
+def run(count, seed, compact):
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    qsos = [adif_merge.fixup_qso(qso, filename, compact)
+            for filename, qso in iter_synthetic_qsos(count, seed)]
+    read = len(qsos)
+    qsos = adif_merge.merge_qsos(qsos, adif_merge.MERGE_WINDOW)
+    print("{:8s} {} QSOs merged to {} in {:.1f}s, peak RSS {:.0f} MB".format(
+        "compact" if compact else "dict", read, len(qsos),
+        time.perf_counter() - start, peak_rss_mb() - baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="QSO record memory benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--count', type=int, default=420000,
+                        help="Number of synthetic contacts, each logged in up to three logs")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Random seed for the synthetic log")
+    parser.add_argument('--mode', choices=["dict", "compact"],
+                        help="Only measure one record type (in this process)")
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.count, args.seed, args.mode == "compact")
+        return
+    # measure each record type in a fresh process so peak RSS is meaningful
+    for mode in ["dict", "compact"]:
+        subprocess.run([sys.executable, os.path.abspath(__file__),
+                        "--count", str(args.count), "--seed", str(args.seed),
+                        "--mode", mode], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,12 +24,15 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "adif_merge=adif_merge:main",
-            "adif_merge_svc=adif_merge.service:main"
+            "adif_merge_svc=adif_merge.service:main",
+            "adif_merge_bench=adif_merge.benchmark:main"
         ]
     },
-    install_requires=[
-        "adif_io"
-    ],
+    install_requires=[],
+    extras_require={
+        "parquet": ["pyarrow"],
+        "fast": ["numpy"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU Affero General Public License v3 or later (AGPLv3+)",